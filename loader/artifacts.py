@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+import os
+import json
+import logging
+import numpy as np
+from datetime import datetime
+
+
+class ArrayWriter:
+    """
+    Preallocated .npy file filled batch by batch through a memory map
+    """
+
+    def __init__(self, path, rows, columns=None, dtype=np.float32):
+        shape = (rows, ) if columns is None else (rows, columns)
+        self.path = path
+        self.array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        self.position = 0
+
+    def write(self, batch):
+        batch = np.asarray(batch)
+        self.array[self.position:self.position + len(batch)] = batch
+        self.position += len(batch)
+
+    def advance(self, rows):
+        """
+        Count rows filled directly through array, e.g. by a device-to-host copy
+        """
+        if self.position + rows > len(self.array):
+            raise ValueError(f"{self.path}: {self.position} + {rows} rows exceed the {len(self.array)} preallocated")
+        self.position += rows
+
+    def close(self):
+        if self.position != len(self.array):
+            logging.warning(f"{self.path}: wrote {self.position} of {len(self.array)} preallocated rows")
+        self.array.flush()
+        del self.array
+
+
+def write_manifest(folder, filename, model, checkpoint, ids, files, seconds=None):
+    """
+    Record what produced the arrays of a prediction folder and the card id of every row
+    :param files: mapping from artifact name (probs, labels, ...) to file name inside folder
+    :param seconds: inference time of the whole folder, the cost of the model when ensembling
+    """
+    np.save(os.path.join(folder, "ids.npy"), np.asarray(ids, dtype=str))
+    manifest = {
+        'model': model,
+        'checkpoint': checkpoint,
+        'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'rows': len(ids),
+        'seconds': seconds,
+        'ids': "ids.npy",
+        'files': files,
+    }
+    with open(os.path.join(folder, filename), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def read_manifest(folder, filename):
+    with open(os.path.join(folder, filename)) as f:
+        return json.load(f)
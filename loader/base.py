@@ -2,70 +2,169 @@
 import sys
 import os
 import os.path
-from sklearn.metrics import precision_score, recall_score, f1_score, classification_report, multilabel_confusion_matrix
 import numpy as np
 import logging
 import pandas as pd
-from loader.tags import Tags
+from loader.tags import Tags, unpack_requirements
+from loader.artifacts import ArrayWriter, write_manifest, read_manifest
+from util.metrics import ConfusionCounts
+from loader.tokens import TokenCache
+from util.store import MetricsStore
 from datetime import datetime
+from functools import cached_property
 
 logging.basicConfig(format='%(asctime)s - %(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s',
                     level=logging.INFO)
 
 
+def dataset_property(name):
+    """
+    Attribute filled by BaseLoader.load_dataset on first access, assignable like a plain attribute
+    """
+    def load(self):
+        self.load_dataset()
+        return self.__dict__[name]
+    return cached_property(load)
+
+
 class BaseLoader:
     base_dir = "runtime"
     data_dir = "data"
     cached_prob_dir = "resource/data"
     name = "Base"
+    prob_dir = "prob"
     score_filename = "score.txt"
-    label_filename = "labels.txt"
+    prob_filename = "probs.npy"
+    label_filename = "labels.npy"
+    final_prob_filename = "final_probs.npy"
+    manifest_filename = "manifest.json"
+    metrics_filename = "metrics.sqlite"
+    threshold_filename = "thresholds.npy"
+    token_dir = "tokens"
 
     inner_train_data = []
     train_data = []
     test_data = []
-    all_data = []
 
-    def __init__(self, token=""):
-        # Initialize directory
-        if not os.path.exists(self.base_dir):
-            os.mkdir(self.base_dir)
+    def __init__(self, token="", incremental=False):
+        """
+        Nothing is created or parsed here: the runtime folders are made when storage_folder is first
+        used and the Tags dataset is loaded when one of the dataset attributes is first read.
+        :param token: name of the runtime folder, a timestamped one by default
+        :param incremental: only keep cards added or changed since the last commit_delta(), which Engine.train
+            calls once training finished
+        """
         date_token = token
         if len(token) == 0:
             date_token = self.name + " "
             date_token += datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.storage_folder = os.path.join(self.base_dir, date_token)
-        logging.info(f"Initialized score directory in {self.storage_folder}")
-        self.ref_dir = os.path.join(self.storage_folder, "ref")
-        self.res_dir = os.path.join(self.storage_folder, "res")
-        if not os.path.exists(self.storage_folder):
-            os.mkdir(self.storage_folder)
+        self.date_token = date_token
+        self.incremental = incremental
+        # model, checkpoint, epoch and step recorded with every evaluation, see log_context
+        self.context = {}
+
+    @cached_property
+    def storage_folder(self):
+        # Initialize directory
+        if not os.path.exists(self.base_dir):
+            os.mkdir(self.base_dir)
+        storage_folder = os.path.join(self.base_dir, self.date_token)
+        logging.info(f"Initialized score directory in {storage_folder}")
+        if not os.path.exists(storage_folder):
+            os.mkdir(storage_folder)
         else:
-            logging.warning(f"Directory {self.storage_folder} already exists!")
-        if not os.path.exists(self.ref_dir):
-            os.mkdir(self.ref_dir)
-        if not os.path.exists(self.res_dir):
-            os.mkdir(self.res_dir)
+            logging.warning(f"Directory {storage_folder} already exists!")
+        for folder in ["ref", "res"]:
+            if not os.path.exists(os.path.join(storage_folder, folder)):
+                os.mkdir(os.path.join(storage_folder, folder))
+        return storage_folder
+
+    @property
+    def ref_dir(self):
+        return os.path.join(self.storage_folder, "ref")
+
+    @property
+    def res_dir(self):
+        return os.path.join(self.storage_folder, "res")
+
+    tags = dataset_property('tags')
+    label_matrix = dataset_property('label_matrix')
+    all_data = dataset_property('all_data')
+    final_data = dataset_property('final_data')
+    all_categorical_data = dataset_property('all_categorical_data')
+    delta = dataset_property('delta')
 
+    def load_dataset(self):
         # Initialize task dataset
         task = Tags(os.path.join(self.data_dir))
         task.load()
+        self.tags = task
+        self.label_matrix = task.label_matrix
         self.all_data = task.df
-        self.final_data = task.df
-        self.all_categorical_data = task.df
+        self.delta = None
+        if self.incremental:
+            self.delta = task.diff()
+            rows = self.delta.rows()
+            rows = rows[~task.df['id'].iloc[rows].isin(self.delta.removed).to_numpy()]
+            self.label_matrix = task.label_matrix[rows]
+            self.all_data = task.df.iloc[rows].reset_index(drop=True)
+            logging.info(f"Incremental mode: {self.delta}")
+        self.final_data = self.all_data
+        self.all_categorical_data = self.all_data
 
         logging.debug(f"All data header:")
         logging.debug(self.all_data.head())
         logging.debug(f"Final evaluation data header:")
         logging.debug(self.final_data.head())
 
+    def dense_labels(self, index=None, dtype=np.float32):
+        """
+        Materialize rows of the packed label matrix aligned with all_data
+        :param index: optional integer or boolean row index
+        :param dtype: dtype of the dense matrix
+        :return: dense matrix of shape (rows, label_dim)
+        """
+        packed = self.label_matrix if index is None else self.label_matrix[index]
+        return unpack_requirements(packed, self.tags.label_dim, dtype)
+
+    def commit_delta(self):
+        """
+        Mark the currently loaded Tags dataset as processed for the next incremental run
+        Engine.train does this after an incremental run, models outside Engine have to call it themselves.
+        """
+        self.tags.commit()
+
+    @cached_property
+    def metrics(self):
+        return MetricsStore(os.path.join(self.base_dir, self.metrics_filename))
+
+    @cached_property
+    def tokens(self):
+        """
+        Token cache shared by every run under the runtime folder
+        """
+        return TokenCache(os.path.join(self.base_dir, self.token_dir))
+
+    def log_context(self, **context):
+        """
+        Set the model, checkpoint, epoch or step recorded with the following evaluations
+        """
+        self.context.update(context)
+
     def eval(self, labels, predictions, threshold=0.5):
-        predictions[predictions >= threshold] = 1
-        predictions[predictions < threshold] = 0
-        task_confusion_matrix = multilabel_confusion_matrix(labels, predictions)
-        task_precision = precision_score(labels, predictions, average='weighted')
-        task_recall = recall_score(labels, predictions, average='weighted')
-        task_f1 = f1_score(labels, predictions, average='weighted')
+        """
+        Score predictions binarized at threshold, the inputs are left untouched
+        Every evaluation is appended to the metrics store, score.txt only holds the latest one.
+        :return: ConfusionCounts of the evaluation
+        """
+        return self.eval_counts(ConfusionCounts.from_dense(labels, predictions, threshold))
+
+    def eval_counts(self, counts):
+        """
+        Score confusion counts accumulated elsewhere, e.g. by model.evaluation.EvalAccumulator.count, like eval
+        """
+        task_precision, task_recall, task_f1 = counts.score('weighted')
+        self.metrics.append(self.date_token, counts.report(), **self.context)
 
         file_path = os.path.join(self.storage_folder, self.score_filename)
         with open(file_path, "w") as score_file:
@@ -82,32 +181,101 @@ class BaseLoader:
         logging.info(f"F1 score")
         logging.info(task_f1)
         logging.info(f"Score file written to {file_path}")
+        return counts
 
     def eval_per(self, labels, predictions, class_name, class_value, threshold=0.5):
-        predictions[predictions >= threshold] = 1
-        predictions[predictions < threshold] = 0
-        task_confusion_matrix = multilabel_confusion_matrix(labels, predictions)
-        task_precision = precision_score(labels, predictions, average='weighted')
-        task_recall = recall_score(labels, predictions, average='weighted')
-        task_f1 = f1_score(labels, predictions, average='weighted')
-        filename = "score" + f'{class_name}_{class_value}.txt'
-        file_path = os.path.join(self.storage_folder, filename)
-        with open(file_path, "w") as score_file:
-            score_file.write('task1_precision:' + str(task_precision) + '\n')
-            score_file.write('task1_recall:' + str(task_recall) + '\n')
-            score_file.write('task1_f1:' + str(task_f1) + '\n')
-            score_file.write(f'{class_name}_{class_value} total_samples:' + str(len(labels)) + '\n')
+        """
+        Score the predictions of one slice of the data into the metrics store, the inputs are left untouched
+        :return: ConfusionCounts of the slice
+        """
+        counts = ConfusionCounts.from_dense(labels, predictions, threshold)
+        task_precision, task_recall, task_f1 = counts.score('weighted')
+        self.metrics.append(self.date_token, dict(counts.report(), cards=len(labels)),
+                            slice=class_name, value=class_value, **self.context)
 
         logging.info(f'{class_name}_{class_value} result:')
-        #logging.info(f"Confusion matrix")
-        #logging.info(task_confusion_matrix)
         logging.info(f"Precision score")
         logging.info(task_precision)
         logging.info(f"Recall score")
         logging.info(task_recall)
         logging.info(f"F1 score")
         logging.info(task_f1)
-        logging.info(f"Score file written to {file_path}")
+        return counts
+
+    def eval_slices(self, table):
+        """
+        Append a slice table, see util.slices.slice_table, to the metrics store
+        """
+        self.metrics.append_table(self.date_token, table, **self.context)
+        logging.info(f"Scored {len(table)} slices into {self.metrics.path}")
+
+    @property
+    def prob_folder(self):
+        folder = os.path.join(self.storage_folder, self.prob_dir)
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def prob_writers(self, rows, prob_columns, label_columns=None, dtype=np.float32):
+        """
+        Preallocate the probability and label files of a prediction run, to be filled batch by batch
+        :param rows: number of predicted rows
+        :param prob_columns: number of logits per row
+        :param label_columns: number of labels per row, None for class ids
+        :param dtype: dtype of the stored logits, float16 halves the files
+        :return: ArrayWriter for the logits, ArrayWriter for the labels
+        """
+        return (ArrayWriter(os.path.join(self.prob_folder, self.prob_filename), rows, prob_columns, dtype),
+                ArrayWriter(os.path.join(self.prob_folder, self.label_filename), rows, label_columns, np.float32))
+
+    def prob_manifest(self, model, checkpoint, ids, seconds=None):
+        """
+        Record the model, checkpoint, row order and inference time of the stored probabilities
+        """
+        return write_manifest(self.prob_folder, self.manifest_filename, model, checkpoint, ids,
+                              {'probs': self.prob_filename, 'labels': self.label_filename}, seconds)
+
+    def prob(self, labels, probs, model="", checkpoint="", ids=None, seconds=None):
+        """
+        Store the logits and labels of a whole prediction run
+        :param ids: card id of every row, the ids of test_data by default
+        :param seconds: inference time of the run
+        """
+        labels = np.asarray(labels)
+        probs = np.asarray(probs)
+        prob_writer, label_writer = self.prob_writers(len(probs), probs.shape[1] if probs.ndim > 1 else None,
+                                                      labels.shape[1] if labels.ndim > 1 else None, probs.dtype)
+        prob_writer.write(probs)
+        label_writer.write(labels)
+        prob_writer.close()
+        label_writer.close()
+        if ids is None:
+            ids = self.test_data['id'] if len(self.test_data) == len(probs) else np.arange(len(probs))
+        self.prob_manifest(model, checkpoint, ids, seconds)
+        logging.info(f"Probabilities written to {self.prob_folder}")
+
+    def final_prob(self, probs):
+        np.save(os.path.join(self.prob_folder, self.final_prob_filename), np.asarray(probs))
+
+    def load_prob(self, folder=None, mmap_mode='r'):
+        """
+        Memory-map stored logits and labels
+        Folders written before the switch to .npy are read from their text files.
+        :param folder: prediction folder, the prob folder of this run by default
+        :return: logits, labels
+        """
+        folder = self.prob_folder if folder is None else folder
+        files = {'probs': self.prob_filename, 'labels': self.label_filename}
+        if os.path.isfile(os.path.join(folder, self.manifest_filename)):
+            files = read_manifest(folder, self.manifest_filename)['files']
+        arrays = []
+        for name in ['probs', 'labels']:
+            path = os.path.join(folder, files[name])
+            legacy = os.path.splitext(path)[0] + ".txt"
+            if not os.path.isfile(path) and os.path.isfile(legacy):
+                arrays.append(np.loadtxt(legacy))
+            else:
+                arrays.append(np.load(path, mmap_mode=mmap_mode))
+        return arrays[0], arrays[1]
 
     def final(self, predictions, epoch):
         pass
@@ -7,53 +7,71 @@ import numpy as np
 import logging
 import pandas as pd
 from loader.base import BaseLoader
+from loader.stratify import stratified_folds
 from datetime import datetime
 
 
 class CustomLoader(BaseLoader):
     name = "Fold"
 
-    def __init__(self, token=""):
-        super().__init__(token)
+    def __init__(self, token="", incremental=False):
+        super().__init__(token, incremental)
 
-    def fold(self, k):
+    def partition(self, index):
         """
-        Generate k-fold cross validation dataset
+        Build the id/text/label frame of a partition, its label column holds views of one dense matrix
+        :param index: integer row index into all_data
+        """
+        return pd.DataFrame({
+            'id': self.all_data.id.to_numpy()[index],
+            'text': self.all_data.text.to_numpy()[index],
+            'label': list(self.dense_labels(index))
+        })  # par_id, label and text
+
+    @staticmethod
+    def select(encoded, index):
+        """
+        Take the rows of a fold from inputs encoded once over all_data
+        Datasets only record an indices mapping, arrays and tensors are indexed directly.
+        :param encoded: tokenized Dataset, array or tensor aligned with all_data
+        :param index: integer row index yielded by fold or nested_fold
+        """
+        if hasattr(encoded, 'select'):
+            return encoded.select(index)
+        return encoded[index]
+
+    def fold(self, k, seed=42):
+        """
+        Generate k-fold cross validation indices, stratified on the requirement labels
         :param k: number of folds
-        :return: train_data, test_data
+        :param seed: seed of the fold assignment
+        :return: train_index, test_index into all_data
         """
-        fold_size = int(len(self.all_data) / k)
-        self.all_data = np.random.permutation(self.all_data)
-        self.test_data, self.train_data = np.split(self.all_data.copy(), [fold_size], axis=0)
+        folds = stratified_folds(self.dense_labels(dtype=bool), k, seed)
         for i in range(k):
-            yield self.train_data, self.test_data
-            if i + 1 != k:
-                self.train_data[i * fold_size:(i + 1) * fold_size], self.test_data = \
-                    self.test_data, self.train_data[i * fold_size:(i + 1) * fold_size].copy()
+            self.train_index = np.sort(np.concatenate(folds[:i] + folds[i + 1:]))
+            self.test_index = folds[i]
+            yield self.train_index, self.test_index
 
-    def nested_fold(self, k):
+    def nested_fold(self, k, seed=42):
         """
-        Generate nested k-fold cross validation
+        Generate nested k-fold cross validation indices, stratified on the requirement labels
+        Every outer test fold is paired with k - 1 inner folds over the remaining rows.
         :param k: number of folds
-        :return: train_data, validation_data, test_data
+        :param seed: seed of the fold assignment
+        :return: train_index, valid_index, test_index, outer fold, inner fold
         """
-        fold_size = int(len(self.all_data) / k)
-        self.all_data = np.random.permutation(self.all_data)
-
-        # do a copy and split before the inner loop begins
-        self.test_data, self.train_data = np.split(self.all_data.copy(), [fold_size], axis=0)
+        labels = self.dense_labels(dtype=bool)
+        folds = stratified_folds(labels, k, seed)
 
         # outer loop
         for j in range(k):
-            inner_fold_size = int(len(self.train_data) / k)
-            self.valid_data, self.inner_train_data = np.split(self.train_data.copy(), [inner_fold_size], axis=0)
+            self.test_index = folds[j]
+            rest = np.sort(np.concatenate(folds[:j] + folds[j + 1:]))
+            inner_folds = [rest[fold] for fold in stratified_folds(labels[rest], k - 1, seed + j + 1)]
 
             # inner loop
             for i in range(k - 1):
-                yield self.inner_train_data, self.valid_data, self.test_data, j, i
-                if i + 1 != k - 1:
-                    self.inner_train_data[i * inner_fold_size:(i + 1) * inner_fold_size], self.valid_data = \
-                        self.valid_data, self.inner_train_data[i * inner_fold_size:(i + 1) * inner_fold_size].copy()
-            if j + 1 != k:
-                self.train_data[j * fold_size:(j + 1) * fold_size], self.test_data = \
-                    self.test_data, self.train_data[j * fold_size:(j + 1) * fold_size].copy()
+                self.inner_train_index = np.sort(np.concatenate(inner_folds[:i] + inner_folds[i + 1:]))
+                self.valid_index = inner_folds[i]
+                yield self.inner_train_index, self.valid_index, self.test_index, j, i
@@ -10,6 +10,7 @@ import logging
 import pandas as pd
 from model.BackTranslate import BackTranslate
 from loader.custom import CustomLoader
+from loader.stratify import iterative_stratification
 from datetime import datetime
 from imblearn.over_sampling import RandomOverSampler
 from collections import Counter
@@ -26,35 +27,38 @@ logging.basicConfig(format='%(asctime)s - %(pathname)s[line:%(lineno)d] - %(leve
 class OfficialLoader(CustomLoader):
     name = "Split"
 
-    def __init__(self, token=""):
-        super().__init__(token)
+    def __init__(self, token="", incremental=False):
+        super().__init__(token, incremental)
 
-    def split(self):
-        self.train_data = []  # par_id, label and text
-        for idx in range(len(self.all_data)):
-            id = self.all_data.id[idx]
-            description = self.all_data.text[idx]
-            requirements = self.all_data.requirements[idx]
-            self.train_data.append({
-                'id': id,
-                'text': description,
-                'label': requirements
-            })
-        self.train_data = pd.DataFrame(self.train_data)
-        self.test_data = []  # par_id, label and text
-        for idx in range(len(self.all_data)):
-            id = self.all_data.id[idx]
-            description = self.all_data.text[idx]
-            requirements = self.all_data.requirements[idx]
-            self.test_data.append({
-                'id': id,
-                'text': description,
-                'label': requirements
-            })
-        self.test_data = pd.DataFrame(self.test_data)
+    def split(self, test_size=None, valid_size=0.0, seed=42, stratify=True):
+        """
+        Split all_data into index arrays over the shared frame and label matrix
+        :param test_size: fraction of rows held out for testing, None trains and tests on every row
+        :param valid_size: fraction of rows held out for validation
+        :param seed: seed of the split
+        :param stratify: balance every requirement tag across the partitions
+        """
+        rows = np.arange(len(self.all_data))
+        if test_size is None:
+            self.train_index = self.test_index = rows
+            self.valid_index = rows[:0]
+        else:
+            proportions = [1 - test_size - valid_size, test_size, valid_size]
+            if stratify:
+                partitions = iterative_stratification(self.dense_labels(dtype=bool), proportions, seed)
+            else:
+                partitions = np.random.default_rng(seed).choice(3, len(rows), p=proportions)
+            self.train_index, self.test_index, self.valid_index = [rows[partitions == k] for k in range(3)]
+        self.train_data = self.partition(self.train_index)
+        if self.test_index is self.train_index:
+            self.test_data = self.train_data
+        else:
+            self.test_data = self.partition(self.test_index)
+        self.valid_data = self.partition(self.valid_index)
         # self.train_data.to_csv(os.path.join(self.data_dir, self.official_train_data_filename))
         # self.test_data.to_csv(os.path.join(self.data_dir, self.official_test_data_filename))
-        logging.info(f"Successfully split TEST({len(self.train_data)})/DEV({len(self.test_data)}).")
+        logging.info(f"Successfully split TRAIN({len(self.train_index)})/TEST({len(self.test_index)})"
+                     f"/DEV({len(self.valid_index)}).")
 
     def balance(self):
         pass
@@ -113,7 +117,9 @@ class OfficialLoader(CustomLoader):
         # self.train_data = self.train_data.sample(frac=1, axis=1).reset_index(drop=True)
 
     def process(self):
-        self.all_data = self.all_data[self.all_data.has_requirement == True].reset_index()
+        mask = (self.all_data.has_requirement == True).to_numpy()
+        self.all_data = self.all_data[mask].reset_index()
+        self.label_matrix = self.label_matrix[mask]
         # self.all_data = self.all_data.head(5)
         print(self.all_data)
         # if os.path.isfile(os.path.join(self.data_dir, output_name)):
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+import numpy as np
+
+
+def iterative_stratification(labels, proportions, seed=0):
+    """
+    Assign every row of a multi-label matrix to a partition, keeping each label's share of positives
+    close to the requested proportions (Sechidis et al., "On the Stratification of Multi-Label Data").
+    Rarest labels are distributed first so that they are not left out of any partition.
+    :param labels: (N, L) dense 0/1 label matrix
+    :param proportions: fraction of rows wanted in each partition
+    :param seed: seed of the tie-breaking random generator
+    :return: (N, ) array with the partition of each row
+    """
+    rng = np.random.default_rng(seed)
+    labels = np.asarray(labels).astype(bool)
+    proportions = np.asarray(proportions, dtype=np.float64)
+    proportions = proportions / proportions.sum()
+    n = len(labels)
+    partitions = np.full((n, ), -1, dtype=np.int64)
+    desired = proportions * n
+    desired_per_label = np.outer(proportions, labels.sum(axis=0))
+    remaining = labels.sum(axis=0)
+
+    while remaining.any():
+        label = np.flatnonzero(remaining == remaining[remaining > 0].min())
+        label = rng.choice(label)
+        rows = np.flatnonzero(labels[:, label] & (partitions < 0))
+        rng.shuffle(rows)
+        for row in rows:
+            wanted = desired_per_label[:, label]
+            candidates = np.flatnonzero(wanted == wanted.max())
+            if len(candidates) > 1:
+                candidates = candidates[desired[candidates] == desired[candidates].max()]
+            partition = rng.choice(candidates)
+            partitions[row] = partition
+            desired[partition] -= 1
+            desired_per_label[partition] -= labels[row]
+        remaining -= labels[rows].sum(axis=0)
+
+    # Rows without any label fill the partitions that are still short of rows
+    rows = np.flatnonzero(partitions < 0)
+    rng.shuffle(rows)
+    counts = np.maximum(np.round(desired).astype(np.int64), 0)
+    fill = np.repeat(np.arange(len(proportions)), counts)[:len(rows)]
+    if len(fill) < len(rows):
+        fill = np.concatenate([fill, rng.choice(len(proportions), len(rows) - len(fill), p=proportions)])
+    partitions[rows] = fill
+    return partitions
+
+
+def stratified_folds(labels, k, seed=0):
+    """
+    Partition the rows of a multi-label matrix into k stratified folds
+    :return: list of k sorted index arrays
+    """
+    partitions = iterative_stratification(labels, np.full((k, ), 1 / k), seed)
+    return [np.flatnonzero(partitions == fold) for fold in range(k)]
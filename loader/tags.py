@@ -1,9 +1,17 @@
 import os
+import csv
+import glob
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
 import numpy as np
 import torch
 import pandas as pd
 import re
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.preprocessing import MultiLabelBinarizer
 
 labels = {
@@ -84,71 +92,392 @@ labels = {
 }
 
 
+class TagRegistry:
+    """
+    Constant time lookups between tag ids and names, and vectorized decoding of label scores
+    """
+
+    def __init__(self, tags, label_dim=128):
+        self.label_dim = label_dim
+        self.name_to_id = dict(tags)
+        self.id_to_name = np.full((label_dim, ), "INVALID", dtype=object)
+        for name, id in tags.items():
+            if 0 <= id < label_dim:
+                self.id_to_name[id] = name
+        # NONE marks cards without requirements, it is never predicted nor scored as a tag
+        self.valid = (self.id_to_name != "INVALID") & (self.id_to_name != "NONE")
+        self.valid_ids = np.flatnonzero(self.valid)
+        self.valid_names = self.id_to_name[self.valid_ids]
+
+    def name(self, id):
+        if 0 <= id < self.label_dim:
+            return self.id_to_name[id]
+        return "INVALID"
+
+    def id(self, name):
+        return self.name_to_id.get(name, -1)
+
+    def top_k(self, scores, k=None):
+        """
+        Rank the valid tags of every row by decreasing score
+        :param scores: (N, label_dim) or (label_dim, ) logits or probabilities
+        :param k: keep the k best tags of every row, all valid tags by default
+        :return: (N, k) tag ids and (N, k) scores
+        """
+        scores = np.atleast_2d(np.asarray(scores))[:, self.valid_ids]
+        order = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+        return self.valid_ids[order], np.take_along_axis(scores, order, axis=1)
+
+    def decode(self, scores, k=None, threshold=None):
+        """
+        Decode label scores into per-row tag lists sorted by relevance
+        :param scores: (N, label_dim) or (label_dim, ) logits or probabilities
+        :param k: keep at most k tags per row
+        :param threshold: keep tags scoring above this value, a scalar or a (label_dim, ) vector of per-tag thresholds
+        :return: one list of (name, score) pairs per row
+        """
+        ids, ranked = self.top_k(scores, k)
+        names = self.id_to_name[ids]
+        if threshold is None:
+            keep = np.ones(ranked.shape, dtype=bool)
+        elif np.ndim(threshold) == 0:
+            keep = ranked > threshold
+        else:
+            keep = ranked > np.asarray(threshold)[ids]
+        return [list(zip(row_names[row_keep], row_scores[row_keep]))
+                for row_names, row_scores, row_keep in zip(names, ranked, keep)]
+
+
+registry = TagRegistry(labels)
+
+
 def get_tag_name(id):
-    try:
-        index = list(labels.values()).index(id)
-        return list(labels.keys())[index]
-    except:
-        pass
-    return "INVALID"
+    return registry.name(id)
+
 
 def get_tag_id(name):
-    if name in labels:
-        return labels[name]
-    return -1
+    return registry.id(name)
+
+
+# Bump whenever parse() changes its output so cached datasets are invalidated.
+parser_version = 2
+
+# Markup identifiers are removed first, then the "[x]" layout marker and the "@"/"$" placeholders
+# in a second pass, so that markup such as "[<b>x]" is cleaned like the original sequential replaces.
+markup_pattern = re.compile(r"<[^>]*>")
+# A markup match containing another "<", e.g. "<b><<b>b>", is removed differently by the original
+# identifier by identifier replaces, such descriptions fall back to remove_markup.
+nested_markup_pattern = re.compile(r"<[^>]*<[^>]*>")
+placeholder_pattern = re.compile(r"\[x\]|[@$]")
+placeholder_replacements = {"@": "0"}
+requirement_pattern = r"(?:^|~)(\d+)"
+
+
+def remove_markup(description):
+    for identifier in markup_pattern.findall(description):
+        description = description.replace(identifier, "")
+    return description
+
+
+def clean_placeholder(match):
+    return placeholder_replacements.get(match.group(0), "")
+
+
+def clean_descriptions(texts):
+    """
+    Vectorized cleaning of a Series of card descriptions, equal to the original per line replaces
+    """
+    nested = texts.str.contains(nested_markup_pattern)
+    texts = texts.str.replace(markup_pattern, "", regex=True).where(~nested, texts[nested].map(remove_markup))
+    return texts.str.replace(placeholder_pattern, clean_placeholder, regex=True)
+
+
+def pack_requirements(raw, label_dim=128):
+    """
+    Build the bit-packed label matrix of a column of raw requirement strings
+    :param raw: Series of "id:value~id:value~" requirement strings
+    :param label_dim: number of labels
+    :return: uint8 matrix of shape (len(raw), label_dim / 8), bit i of a row set when tag i is required
+    """
+    packed = np.zeros((len(raw), (label_dim + 7) // 8), dtype=np.uint8)
+    found = raw.reset_index(drop=True).str.extractall(requirement_pattern)
+    if len(found) > 0:
+        rows = found.index.get_level_values(0).to_numpy()
+        tags = found[0].astype(np.int64).to_numpy()
+        if tags.max() >= label_dim:
+            raise IndexError(f"Requirement {tags.max()} is out of bounds for {label_dim} labels")
+        np.bitwise_or.at(packed, (rows, tags >> 3), (1 << (tags & 7)).astype(np.uint8))
+    return packed
+
+
+def unpack_requirements(packed, label_dim=128, dtype=np.float32):
+    """
+    Materialize a bit-packed label matrix as a dense one
+    :param packed: uint8 matrix produced by pack_requirements
+    :param label_dim: number of labels
+    :param dtype: dtype of the dense matrix
+    :return: dense matrix of shape (len(packed), label_dim)
+    """
+    return np.unpackbits(packed, axis=1, count=label_dim, bitorder='little').astype(dtype)
+
+
+def row_hashes(df, label_matrix):
+    """
+    Hash the text and requirements of every card
+    :return: uint64 array aligned with df
+    """
+    label_matrix = np.asarray(label_matrix)
+    width = -label_matrix.shape[1] % 8
+    words = np.ascontiguousarray(np.pad(label_matrix, ((0, 0), (0, width)))).view(np.uint64)
+    columns = {'text': df['text'].reset_index(drop=True)}
+    for column in range(words.shape[1]):
+        columns[f'labels{column}'] = words[:, column]
+    return pd.util.hash_pandas_object(pd.DataFrame(columns), index=False).to_numpy()
+
+
+class TagsDelta:
+    """
+    Rows of a loaded Tags dataset that differ from the previously ingested snapshot
+    added and changed are positional indices into the new dataset, removed holds card ids.
+    """
+
+    def __init__(self, added, changed, removed):
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+
+    def rows(self):
+        return np.sort(np.concatenate([self.added, self.changed]))
+
+    def __len__(self):
+        return len(self.added) + len(self.changed) + len(self.removed)
+
+    def __repr__(self):
+        return f"TagsDelta(added={len(self.added)}, changed={len(self.changed)}, removed={len(self.removed)})"
+
+
+def read_tags(path, use_cache=True):
+    """
+    Process pool entry point reading one Tags dump
+    :return: DataFrame, packed label matrix and parse time in seconds
+    """
+    start = time.perf_counter()
+    df, label_matrix = Tags(path, use_cache=use_cache).read(path)
+    return df, label_matrix, time.perf_counter() - start
 
 
 class Tags:
     label_dim = 128
-    def __init__(self, data_path):
+    pattern = '* Tags.csv'
+    columns = ['name', 'id', 'text', 'requirements', 'tags']
+    chunk_size = 4096
+    cache_dirname = ".cache"
+    cache_columns = ['id', 'text', 'has_requirement']
 
+    def __init__(self, data_path, use_cache=True, workers=None):
+        """
+        :param data_path: a Tags csv file, a directory of timestamped dumps or a glob pattern
+        :param use_cache: reuse parsed datasets cached next to the dumps
+        :param workers: size of the process pool parsing several dumps, defaults to the cpu count
+        """
         self.data_path = data_path
+        self.use_cache = use_cache
+        self.workers = workers or os.cpu_count()
         self.df = None
+        self.label_matrix = None
+        self.parse_times = {}
 
-    def construct_requirements(self, raw):
-        splits = raw.split("~")
-        dims = np.zeros((self.label_dim, ))
-        for split in splits:
-            if len(split) == 0:
-                continue
-            items = split.split(":")
-            dims[int(items[0])] = 1 # int(items[1])
-        return dims
+    def parse(self, path):
+        """
+        Stream a "^" separated Tags dump into a typed DataFrame and a packed label matrix
+        :param path: path of the Tags csv file
+        :return: DataFrame with id, text and has_requirement columns, packed label matrix
+        """
+        frames = []
+        matrices = []
+        reader = pd.read_csv(path, sep="^", header=None, names=self.columns, usecols=range(len(self.columns)),
+                             dtype=str, quoting=csv.QUOTE_NONE, na_filter=False, engine="c",
+                             chunksize=self.chunk_size)
+        for chunk in reader:
+            raw = chunk['requirements']
+            matrices.append(pack_requirements(raw, self.label_dim))
+            frames.append(pd.DataFrame({
+                'id': chunk['id'],
+                'text': clean_descriptions(chunk['text']),
+                'has_requirement': raw.str.len() > 0,
+            }))
+        if len(frames) == 0:
+            return pd.DataFrame(columns=['id', 'text', 'has_requirement']), \
+                np.zeros((0, (self.label_dim + 7) // 8), dtype=np.uint8)
+        return pd.concat(frames, ignore_index=True), np.concatenate(matrices)
+
+    def cache_key(self, path):
+        """
+        Hash the content of a Tags dump together with the parser version
+        :param path: path of the Tags csv file
+        :return: hex digest identifying the parsed dataset
+        """
+        digest = hashlib.sha1(f"{parser_version}:{self.label_dim}:".encode())
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def cache_path(self, path, key):
+        return os.path.join(os.path.dirname(path), self.cache_dirname, f"{os.path.basename(path)} {key}")
+
+    def read_cache(self, path, key):
+        """
+        Read a cached dataset
+        Only the packed label matrix stays memory-mapped. The id, text and has_requirement columns are read
+        into memory, pandas string operations need Python strings rather than fixed-width arrays.
+        :return: DataFrame and packed label matrix, or None when no cache exists
+        """
+        folder = self.cache_path(path, key)
+        if not os.path.isdir(folder):
+            return None
+        df = pd.DataFrame({column: np.load(os.path.join(folder, f"{column}.npy"))
+                           for column in self.cache_columns})
+        df['id'] = df['id'].astype(str)
+        df['text'] = df['text'].astype(str)
+        label_matrix = np.load(os.path.join(folder, "label_matrix.npy"), mmap_mode="r")
+        return df, label_matrix
+
+    def write_cache(self, path, key, df, label_matrix):
+        """
+        Atomically store a parsed dataset and drop stale caches of the same dump
+        """
+        folder = self.cache_path(path, key)
+        root = os.path.dirname(folder)
+        os.makedirs(root, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=root)
+        for column in self.cache_columns:
+            values = df[column].to_numpy(dtype=bool if column == 'has_requirement' else str)
+            np.save(os.path.join(staging, f"{column}.npy"), values)
+        np.save(os.path.join(staging, "label_matrix.npy"), label_matrix)
+        try:
+            os.replace(staging, folder)
+        except OSError:
+            # Another process cached the same content first
+            shutil.rmtree(staging, ignore_errors=True)
+        prefix = f"{os.path.basename(path)} "
+        for entry in os.listdir(root):
+            if entry.startswith(prefix) and os.path.join(root, entry) != folder:
+                shutil.rmtree(os.path.join(root, entry), ignore_errors=True)
+
+    def read(self, path):
+        """
+        Parse a Tags dump, reusing the on-disk cache when its content is unchanged
+        :param path: path of the Tags csv file
+        :return: DataFrame and packed label matrix
+        """
+        if not self.use_cache:
+            return self.parse(path)
+        key = self.cache_key(path)
+        cached = self.read_cache(path, key)
+        if cached is not None:
+            logging.info(f"Using cached Tags dataset {key} for {path}")
+            return cached
+        df, label_matrix = self.parse(path)
+        self.write_cache(path, key, df, label_matrix)
+        return df, label_matrix
+
+    def sources(self):
+        """
+        Resolve data_path to the Tags dumps it designates, oldest first
+        Timestamped dump names sort chronologically, so the newest dump comes last.
+        """
+        if os.path.isdir(self.data_path):
+            paths = glob.glob(os.path.join(self.data_path, self.pattern))
+        elif glob.has_magic(self.data_path):
+            paths = glob.glob(self.data_path)
+        else:
+            paths = [self.data_path]
+        paths = sorted(paths, key=os.path.basename)
+        if len(paths) == 0:
+            raise FileNotFoundError(f"No Tags dump matches {self.data_path}")
+        return paths
+
+    @staticmethod
+    def merge(frames, matrices):
+        """
+        Union several parsed dumps, a card id keeps the row of the last dump that contains it
+        :param frames: DataFrames ordered from oldest to newest
+        :param matrices: packed label matrices aligned with frames
+        :return: merged DataFrame and packed label matrix
+        """
+        if len(frames) == 1:
+            return frames[0], matrices[0]
+        seen = pd.Index([])
+        kept_frames = []
+        kept_matrices = []
+        for df, label_matrix in zip(reversed(frames), reversed(matrices)):
+            keep = ~df['id'].isin(seen).to_numpy()
+            seen = seen.append(pd.Index(df['id']))
+            kept_frames.append(df[keep])
+            kept_matrices.append(label_matrix[keep])
+        return pd.concat(kept_frames[::-1], ignore_index=True), np.concatenate(kept_matrices[::-1])
 
     def load(self):
-        data = defaultdict(list)
-        ids = []
-        descriptions = []
-        requirements = []
-        has_requirements = []
-        with open(os.path.join(self.data_path, '2022-11-16-16-28-26 Tags.csv')) as f:
-            for line in f.readlines():
-                line = line.strip()
-                indices = line.split("^")
-                card_name = indices[0]
-                card_id = indices[1]
-                card_description = indices[2]
-                for identifier in re.findall("<[^>]*>", card_description):
-                    card_description = card_description.replace(identifier, "")
-                card_description = card_description.replace("[x]", "").replace("@", "0").replace("$", "")
-                card_requirements_raw = indices[3]
-                card_tags_raw = indices[4]
-                card_requirements = self.construct_requirements(card_requirements_raw)
-                if len(card_requirements_raw) > 0:
-                    has_requirement = True
-                else:
-                    has_requirement = False
-                ids.append(card_id)
-                descriptions.append(card_description)
-                requirements.append(card_requirements)
-                has_requirements.append(has_requirement)
-
-
-        self.df = pd.DataFrame(list(zip(ids,
-                                   descriptions,
-                                   requirements,
-                                   has_requirements
-                                   )), columns=['id', 'text', 'requirements', 'has_requirement'])
+        paths = self.sources()
+        if len(paths) == 1 or self.workers == 1:
+            results = [read_tags(path, self.use_cache) for path in paths]
+        else:
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(paths))) as executor:
+                results = list(executor.map(read_tags, paths, [self.use_cache] * len(paths)))
+        for path, (df, _, seconds) in zip(paths, results):
+            self.parse_times[path] = seconds
+            logging.info(f"Loaded {len(df)} cards from {path} in {seconds:.3f}s")
+        self.df, self.label_matrix = self.merge([result[0] for result in results],
+                                                [result[1] for result in results])
+
+    def snapshot_path(self):
+        root = self.data_path if os.path.isdir(self.data_path) else os.path.dirname(self.sources()[0])
+        return os.path.join(root, self.cache_dirname, "snapshot")
+
+    def diff(self):
+        """
+        Compare the loaded dataset with the last committed snapshot by card id and row hash
+        Every row counts as added when no snapshot was committed yet.
+        :return: TagsDelta
+        """
+        hashes = row_hashes(self.df, self.label_matrix)
+        folder = self.snapshot_path()
+        if not os.path.isdir(folder):
+            return TagsDelta(np.arange(len(self.df)), np.array([], dtype=np.int64), np.array([], dtype=str))
+        previous_ids = pd.Index(np.load(os.path.join(folder, "id.npy")))
+        previous_hashes = np.load(os.path.join(folder, "hash.npy"))
+        unique = ~previous_ids.duplicated(keep='last')
+        previous_ids, previous_hashes = previous_ids[unique], previous_hashes[unique]
+        positions = previous_ids.get_indexer(self.df['id'])
+        found = positions >= 0
+        changed = np.zeros(found.shape, dtype=bool)
+        changed[found] = previous_hashes[positions[found]] != hashes[found]
+        removed = previous_ids[~previous_ids.isin(self.df['id'])]
+        logging.info(f"Tags delta: {found.size - found.sum()} added, {changed.sum()} changed, {len(removed)} removed")
+        return TagsDelta(np.flatnonzero(~found), np.flatnonzero(changed), removed.to_numpy(dtype=str))
+
+    def commit(self):
+        """
+        Record the loaded dataset as the snapshot the next diff compares against
+        """
+        folder = self.snapshot_path()
+        os.makedirs(os.path.dirname(folder), exist_ok=True)
+        staging = tempfile.mkdtemp(dir=os.path.dirname(folder))
+        np.save(os.path.join(staging, "id.npy"), self.df['id'].to_numpy(dtype=str))
+        np.save(os.path.join(staging, "hash.npy"), row_hashes(self.df, self.label_matrix))
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(staging, folder)
+
+    def dense_labels(self, index=None, dtype=np.float32):
+        """
+        Materialize (a subset of) the label matrix as dense rows
+        :param index: optional integer or boolean row index
+        :param dtype: dtype of the dense matrix
+        :return: dense matrix of shape (rows, label_dim)
+        """
+        packed = self.label_matrix if index is None else self.label_matrix[index]
+        return unpack_requirements(packed, self.label_dim, dtype)
 
     def load_test(self):
         pass
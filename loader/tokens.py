@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+import os
+import json
+import uuid
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+worker_state = {}
+
+
+def text_hashes(texts):
+    """
+    :return: uint64 content hash of every text
+    """
+    return pd.util.hash_array(np.asarray(texts, dtype=object))
+
+
+def init_worker(tokenizer, settings):
+    worker_state['tokenizer'] = tokenizer
+    worker_state['settings'] = settings
+
+
+def tokenize_batch(texts):
+    return worker_state['tokenizer'](texts, **worker_state['settings'])['input_ids']
+
+
+def tokenize_texts(tokenizer, texts, settings, batch_size=1000, workers=None):
+    """
+    Token ids of texts, tokenized in batches
+    Fast tokenizers encode a batch on all cores in Rust, slow Python tokenizers are copied once into every
+    process of a pool which tokenizes the batches concurrently.
+    :param settings: keyword arguments of the tokenizer call
+    :param workers: processes used for a slow tokenizer, one per core by default, 1 tokenizes in this process
+    :return: list of token id lists aligned with texts
+    """
+    texts = list(texts)
+    batches = [texts[start:start + batch_size] for start in range(0, len(texts), batch_size)]
+    workers = min(workers or os.cpu_count(), len(batches))
+    if getattr(tokenizer, 'is_fast', False) or workers <= 1:
+        return [ids for batch in batches for ids in tokenizer(batch, **settings)['input_ids']]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(tokenizer, settings)) as executor:
+        return [ids for encoded in executor.map(tokenize_batch, batches) for ids in encoded]
+
+
+def tokenizer_key(tokenizer, settings):
+    """
+    Name of the cache folder of a tokenizer and its call settings
+    The class, checkpoint, vocabulary size and special tokens identify the tokenizer, so that slow and
+    fast implementations or tokenizers with added tokens never share ids.
+    """
+    identity = {
+        'class': type(tokenizer).__name__,
+        'name_or_path': getattr(tokenizer, 'name_or_path', ''),
+        'vocab_size': len(tokenizer),
+        'special_tokens': getattr(tokenizer, 'all_special_tokens', []),
+        'settings': settings,
+    }
+    return hashlib.sha1(json.dumps(identity, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def locate(segments, hashes):
+    """
+    :return: position of every hash in the concatenated segments, -1 for texts no segment holds
+    """
+    if not segments:
+        return np.full(len(hashes), -1)
+    stored = np.concatenate([segment.hashes for segment in segments])
+    # Concurrent writers may store a text twice, the first copy is used
+    first = np.flatnonzero(~pd.Index(stored).duplicated())
+    found = pd.Index(stored[first]).get_indexer(hashes)
+    return np.where(found < 0, -1, first[found])
+
+
+class TokenSegment:
+    """
+    Token ids of a batch of unique texts stored flat, memory-mapped from a folder
+    """
+    files = ['hashes', 'input_ids', 'offsets']
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.hashes, self.input_ids, self.offsets = [np.load(os.path.join(folder, f"{name}.npy"), mmap_mode='r')
+                                                     for name in self.files]
+
+    def __getstate__(self):
+        # DataLoader workers map the files again instead of receiving a pickled copy of the arrays
+        return {'folder': self.folder}
+
+    def __setstate__(self, state):
+        self.__init__(state['folder'])
+
+    @staticmethod
+    def write(folder, name, hashes, encoded, manifest):
+        """
+        Write a segment through a temporary folder, readers in other processes only ever see complete segments
+        :param encoded: list of token id lists aligned with hashes
+        """
+        lengths = np.fromiter((len(ids) for ids in encoded), dtype=np.int64, count=len(encoded))
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        input_ids = np.fromiter((id for ids in encoded for id in ids), dtype=np.int32, count=offsets[-1])
+        temporary = os.path.join(folder, f".{name}.{uuid.uuid4().hex}")
+        os.makedirs(temporary)
+        for filename, array in zip(TokenSegment.files, [hashes, input_ids, offsets]):
+            np.save(os.path.join(temporary, f"{filename}.npy"), array)
+        with open(os.path.join(temporary, "manifest.json"), "w") as f:
+            json.dump(dict(manifest, rows=len(hashes), tokens=int(offsets[-1]),
+                           created=datetime.now().strftime("%Y-%m-%d %H:%M:%S")), f, indent=2)
+        try:
+            os.rename(temporary, os.path.join(folder, name))
+        except OSError:
+            # Another process wrote the same segment first
+            for filename in os.listdir(temporary):
+                os.remove(os.path.join(temporary, filename))
+            os.rmdir(temporary)
+
+
+class Tokens:
+    """
+    Token ids of a sequence of texts, row i is read from the segment that holds text i
+    """
+
+    def __init__(self, segments, segment, row):
+        self.segments = segments
+        self.segment = segment
+        self.row = row
+        starts = np.empty(len(row), dtype=np.int64)
+        ends = np.empty(len(row), dtype=np.int64)
+        for position, stored in enumerate(segments):
+            members = segment == position
+            starts[members] = stored.offsets[row[members]]
+            ends[members] = stored.offsets[row[members] + 1]
+        self.starts = starts
+        self.lengths = ends - starts
+
+    def __len__(self):
+        return len(self.row)
+
+    def __getitem__(self, index):
+        stored = self.segments[self.segment[index]]
+        return stored.input_ids[self.starts[index]:self.starts[index] + self.lengths[index]]
+
+
+class TokenCache:
+    """
+    Persistent pre-tokenization shared by every model and fold using the same tokenizer
+    Texts are content-addressed: the folder of a tokenizer and its settings holds segments named after the
+    content hash of the dataset that first needed them, and every segment stores the hash of each of its
+    texts. Encoding a dataset only tokenizes the texts no segment holds yet, so later folds, partitions and
+    models sharing the tokenizer read memory-mapped ids without tokenizing again.
+    """
+
+    def __init__(self, folder, batch_size=1000, workers=None):
+        """
+        :param workers: processes tokenizing with a slow tokenizer, see tokenize_texts
+        """
+        self.folder = folder
+        self.batch_size = batch_size
+        self.workers = workers
+
+    def segments(self, folder):
+        if not os.path.isdir(folder):
+            return []
+        return [TokenSegment(os.path.join(folder, name)) for name in sorted(os.listdir(folder))
+                if not name.startswith(".") and os.path.isdir(os.path.join(folder, name))]
+
+    def tokenize(self, tokenizer, texts, settings):
+        return tokenize_texts(tokenizer, texts, settings, self.batch_size, self.workers)
+
+    def encode(self, tokenizer, texts, **settings):
+        """
+        :param tokenizer: transformers tokenizer
+        :param texts: sequence of strings, e.g. the text column of a partition
+        :param settings: keyword arguments of the tokenizer call, e.g. max_length and truncation
+        :return: Tokens aligned with texts
+        """
+        texts = np.asarray(texts, dtype=object)
+        folder = os.path.join(self.folder, tokenizer_key(tokenizer, settings))
+        hashes = text_hashes(texts)
+        segments = self.segments(folder)
+        position = locate(segments, hashes)
+        if (position < 0).any():
+            rows = np.flatnonzero(position < 0)
+            rows = np.sort(rows[np.unique(hashes[rows], return_index=True)[1]])
+            name = hashlib.sha1(hashes.tobytes()).hexdigest()[:16]
+            logging.info(f"Tokenizing {len(rows)} of {len(texts)} texts into {os.path.join(folder, name)}")
+            os.makedirs(folder, exist_ok=True)
+            manifest = {'tokenizer': type(tokenizer).__name__,
+                        'name_or_path': getattr(tokenizer, 'name_or_path', ''), 'settings': settings}
+            TokenSegment.write(folder, name, hashes[rows], self.tokenize(tokenizer, texts[rows].tolist(), settings),
+                               manifest)
+            segments = self.segments(folder)
+            position = locate(segments, hashes)
+        bounds = np.cumsum([0] + [len(segment.hashes) for segment in segments])
+        segment = np.searchsorted(bounds, position, side='right') - 1
+        return Tokens(segments, segment, position - bounds[segment])
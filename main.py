@@ -23,13 +23,14 @@ model_names = ['DeBERTaV3Large', 'DeBERTaV2XLarge', 'DeBERTaBase', 'DeBERTaLarge
 loader_types = []
 
 
-def get_loader(loader_type, model_name):
+def get_loader(loader_type, model_name, prepare=True):
     # if loader_type not in loader_types:
     #     print(f'Please use a valid loader type, valid types are:\n{loader_types}')
     #     sys.exit(1)
     data_loader = OfficialLoader(model_name)
-    data_loader.process()
-    data_loader.split()
+    if prepare:
+        data_loader.process()
+        data_loader.split()
     return data_loader
 
 
@@ -54,8 +55,7 @@ def get_model(model_name, data_loader, load_existing=False):
 
 if __name__ == "__main__":
     starttime = datetime.datetime.now()
-    loader = get_loader(args.data_type, args.model_name)
-    nlp_model = get_model(args.model_name, loader)
+    loader = get_loader(args.data_type, args.model_name, prepare=bool(args.train))
     if args.train:
         nlp_model = get_model(args.model_name, loader)
         nlp_model.train()
@@ -1,19 +1,31 @@
 from loader.base import BaseLoader
+from util.metrics import compute_metrics
+from model.tokenization import load_tokenizer
+from model.decision import Decision
+from model.evaluation import EvalAccumulator
+from model.batching import PaddingCollator, TokenDataset, batch_loader
 from transformers import BertForSequenceClassification, AdamW, BertConfig, TrainingArguments, Trainer
 from transformers import get_linear_schedule_with_warmup, BertTokenizer
-from datasets import Dataset, load_metric
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 import torch
 import numpy as np
 import pandas as pd
 import os
+from functools import cached_property
 import tqdm
 
 
 class BertBaseUncased:
     train_epochs = 4
     batch_size = 8
-    tokenizer = BertTokenizer.from_pretrained("bert-base-uncased", do_lower_case=True)
+    tokenize_settings = dict(truncation=True, add_special_tokens=True)
+
+    @cached_property
+    def tokenizer(self):
+        return load_tokenizer("bert-base-uncased", BertTokenizer, do_lower_case=True)
+
+    @cached_property
+    def collator(self):
+        return PaddingCollator(self.tokenizer.pad_token_id, self.tokenizer.padding_side)
 
     def __init__(self, loader: BaseLoader, load_existing=False):
         self.data_loader = loader
@@ -34,35 +46,22 @@ class BertBaseUncased:
                                lr=2e-7,
                                eps=1e-8)
 
-    @staticmethod
-    def compute_metrics(eval_pred):
-        logits, labels = eval_pred
-        predictions = np.argmax(logits, axis=-1)
-        precision_metric = load_metric("precision")
-        recall_metric = load_metric("recall")
-        f1_metric = load_metric("f1")
-        precision = precision_metric.compute(predictions=predictions, references=labels)["precision"]
-        recall = recall_metric.compute(predictions=predictions, references=labels)["recall"]
-        f1 = f1_metric.compute(predictions=predictions, references=labels)["f1"]
-        return {"precision": precision, "recall": recall, "f1": f1}
+    compute_metrics = staticmethod(compute_metrics)
+
+    def tokenize_function(self, examples):
+        return self.tokenizer(examples['text'], **self.tokenize_settings)
 
-    @staticmethod
-    def tokenize_function(examples):
-        return BertBaseUncased.tokenizer(examples['text'], padding="max_length", truncation=True, add_special_tokens=True)
+    def encode(self, data):
+        tokens = self.data_loader.tokens.encode(self.tokenizer, data['text'], **self.tokenize_settings)
+        return TokenDataset(tokens, data.get('label'))
 
     def train(self):
-        self.train_dataset = Dataset.from_pandas(pd.DataFrame(self.data_loader.train_data))
-        self.encoded_train_dataset = self.train_dataset.map(self.tokenize_function, batched=True)
+        self.encoded_train_dataset = self.encode(self.data_loader.train_data)
         print(self.encoded_train_dataset)
         print(self.encoded_train_dataset[0])
-        self.test_dataset = Dataset.from_pandas(pd.DataFrame(self.data_loader.test_data))
-        self.encoded_test_dataset = self.test_dataset.map(self.tokenize_function, batched=True)
-        self.train_loader = DataLoader(self.encoded_train_dataset,
-                                       sampler=RandomSampler(self.encoded_train_dataset),
-                                       batch_size=self.batch_size)
-        self.test_loader = DataLoader(self.encoded_test_dataset,
-                                       sampler=RandomSampler(self.encoded_test_dataset),
-                                       batch_size=self.batch_size)
+        self.encoded_test_dataset = self.encode(self.data_loader.test_data)
+        self.train_loader = batch_loader(self.encoded_train_dataset, self.batch_size, self.collator, persistent=True)
+        self.test_loader = batch_loader(self.encoded_test_dataset, self.batch_size, self.collator, shuffle=False)
         self.total_steps = len(self.train_loader) * self.train_epochs
         self.scheduler = get_linear_schedule_with_warmup(self.optimizer,
                                                          num_warmup_steps=0,
@@ -72,10 +71,10 @@ class BertBaseUncased:
             with tqdm.tqdm(self.train_loader, unit="batch") as tepoch:
                 for i, data in enumerate(tepoch):
                     self.model.zero_grad()
-                    result = self.model(torch.stack(data['input_ids']).T.cuda(),
+                    result = self.model(data['input_ids'].cuda(non_blocking=True),
                                         token_type_ids=None,
-                                        attention_mask=torch.stack(data['attention_mask']).T.cuda(),
-                                        labels=torch.tensor(data['label']).cuda(),
+                                        attention_mask=data['attention_mask'].cuda(non_blocking=True),
+                                        labels=data['label'].cuda(non_blocking=True),
                                         return_dict=True)
                     loss = result.loss
                     logits = result.logits
@@ -89,77 +88,61 @@ class BertBaseUncased:
 
             # Evaluation
             self.model.eval()
-            labels = np.array([])
-            predictions = np.array([])
-            eval_loss = 0
+            accumulator = EvalAccumulator(len(self.encoded_test_dataset))
             with tqdm.tqdm(self.test_loader, unit="batch") as tepoch:
                 for i, data in enumerate(tepoch):
                     with torch.no_grad():
-                        result = self.model(torch.stack(data['input_ids']).T.cuda(),
+                        result = self.model(data['input_ids'].cuda(non_blocking=True),
                                             token_type_ids=None,
-                                            attention_mask=torch.stack(data['attention_mask']).T.cuda(),
-                                            labels=torch.tensor(data['label']).cuda(),
+                                            attention_mask=data['attention_mask'].cuda(non_blocking=True),
+                                            labels=data['label'].cuda(non_blocking=True),
                                             return_dict=True)
                         loss = result.loss
                         logits = result.logits
-                        eval_loss += loss.item()
-                        onehot = np.argmax(logits.detach().cpu().numpy(), axis=-1)
-                        labels = np.concatenate([labels, data['label'].numpy()])
-                        predictions = np.concatenate([predictions, onehot])
+                        accumulator.add(loss, labels=data['label'], predictions=Decision.classes(logits))
                         tepoch.set_description(f"Evaluation {epoch}")
                         tepoch.set_postfix(Loss=loss.item())
-            self.data_loader.eval(labels, predictions)
+            self.data_loader.eval(*accumulator.result())
         self.model.save_pretrained(os.path.join(self.data_loader.storage_folder, "output"))
 
     def predict(self):
-        self.test_dataset = Dataset.from_pandas(pd.DataFrame(self.data_loader.test_data))
-        self.encoded_test_dataset = self.test_dataset.map(self.tokenize_function, batched=True)
-        self.test_loader = DataLoader(self.encoded_test_dataset,
-                                      sampler=RandomSampler(self.encoded_test_dataset),
-                                      batch_size=self.batch_size)
+        self.encoded_test_dataset = self.encode(self.data_loader.test_data)
+        self.test_loader = batch_loader(self.encoded_test_dataset, self.batch_size, self.collator, shuffle=False)
         self.model.eval()
-        labels = np.array([])
-        predictions = np.array([])
-        eval_loss = 0
+        accumulator = EvalAccumulator(len(self.encoded_test_dataset))
         with tqdm.tqdm(self.test_loader, unit="batch") as tepoch:
             for i, data in enumerate(tepoch):
                 with torch.no_grad():
-                    result = self.model(torch.stack(data['input_ids']).T.cuda(),
+                    result = self.model(data['input_ids'].cuda(non_blocking=True),
                                         token_type_ids=None,
-                                        attention_mask=torch.stack(data['attention_mask']).T.cuda(),
-                                        labels=torch.tensor(data['label']).cuda(),
+                                        attention_mask=data['attention_mask'].cuda(non_blocking=True),
+                                        labels=data['label'].cuda(non_blocking=True),
                                         return_dict=True)
                     loss = result.loss
                     logits = result.logits
-                    eval_loss += loss.item()
-                    onehot = np.argmax(logits.detach().cpu().numpy(), axis=-1)
-                    labels = np.concatenate([labels, data['label'].numpy()])
-                    predictions = np.concatenate([predictions, onehot])
+                    accumulator.add(loss, labels=data['label'], predictions=Decision.classes(logits))
                     tepoch.set_description(f"Prediction")
                     tepoch.set_postfix(Loss=loss.item())
-        self.data_loader.eval(labels, predictions)
+        self.data_loader.eval(*accumulator.result())
 
     def final(self):
-        self.final_dataset = Dataset.from_pandas(pd.DataFrame(self.data_loader.final_data))
-        self.encoded_final_dataset = self.final_dataset.map(self.tokenize_function, batched=True)
-        self.final_loader = DataLoader(self.encoded_final_dataset,
-                                      sampler=SequentialSampler(self.encoded_final_dataset),
-                                      batch_size=self.batch_size)
+        self.encoded_final_dataset = self.encode(self.data_loader.final_data)
+        self.final_loader = batch_loader(self.encoded_final_dataset, self.batch_size, self.collator, sampling='sequential')
         self.model.eval()
-        predictions = np.array([])
+        accumulator = EvalAccumulator(len(self.encoded_final_dataset))
         with tqdm.tqdm(self.final_loader, unit="batch") as tepoch:
             for i, data in enumerate(tepoch):
                 with torch.no_grad():
-                    result = self.model(torch.stack(data['input_ids']).T.cuda(),
+                    result = self.model(data['input_ids'].cuda(non_blocking=True),
                                         token_type_ids=None,
-                                        attention_mask=torch.stack(data['attention_mask']).T.cuda(),
+                                        attention_mask=data['attention_mask'].cuda(non_blocking=True),
                                         return_dict=True)
                     loss = result.loss
                     logits = result.logits
-                    onehot = np.argmax(logits.detach().cpu().numpy(), axis=-1)
-                    predictions = np.concatenate([predictions, onehot])
+                    accumulator.add(predictions=Decision.classes(logits))
                     tepoch.set_description(f"Final")
                     tepoch.set_postfix(Loss=loss.item())
+        predictions = accumulator['predictions']
         self.data_loader.final(predictions)
         self.prediction = predictions
         print(predictions)
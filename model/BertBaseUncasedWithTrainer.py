@@ -1,9 +1,13 @@
 from loader.base import BaseLoader
-from transformers import BertForSequenceClassification, AdamW, BertConfig, AutoTokenizer, TrainingArguments, Trainer
-from datasets import Dataset, load_metric
+from util.metrics import compute_metrics
+from model.tokenization import load_tokenizer
+from model.batching import TokenDataset, default_workers
+from transformers import BertForSequenceClassification, AdamW, BertConfig, BertTokenizer, TrainingArguments, Trainer, \
+    DataCollatorWithPadding
 import numpy as np
 import pandas as pd
 import os
+from functools import cached_property
 import torch
 
 class UnbalancedLossTrainer(Trainer):
@@ -17,6 +21,15 @@ class UnbalancedLossTrainer(Trainer):
 
 class BertBaseUncasedWithTrainer:
     batch_size = 4
+    tokenize_settings = dict(truncation=True)
+
+    @cached_property
+    def tokenizer(self):
+        return load_tokenizer("bert-base-uncased", BertTokenizer)
+
+    @cached_property
+    def collator(self):
+        return DataCollatorWithPadding(self.tokenizer)
 
     def __init__(self, loader: BaseLoader, load_existing=False):
         self.data_loader = loader
@@ -28,7 +41,9 @@ class BertBaseUncasedWithTrainer:
                                                per_gpu_train_batch_size=self.batch_size,
                                                load_best_model_at_end=True,
                                                evaluation_strategy="epoch",
-                                               save_strategy="epoch"
+                                               save_strategy="epoch",
+                                               group_by_length=True,
+                                               dataloader_num_workers=default_workers()
                                                )
         model_name = "bert-base-uncased"
         local_files_only = False
@@ -45,31 +60,20 @@ class BertBaseUncasedWithTrainer:
         )
         self.model.cuda()
 
-    @staticmethod
-    def compute_metrics(eval_pred):
-        logits, labels = eval_pred
-        predictions = np.argmax(logits, axis=-1)
-        precision_metric = load_metric("precision")
-        recall_metric = load_metric("recall")
-        f1_metric = load_metric("f1")
-        precision = precision_metric.compute(predictions=predictions, references=labels)["precision"]
-        recall = recall_metric.compute(predictions=predictions, references=labels)["recall"]
-        f1 = f1_metric.compute(predictions=predictions, references=labels)["f1"]
-        return {"precision": precision, "recall": recall, "f1": f1}
+    compute_metrics = staticmethod(compute_metrics)
+
+    def tokenize_function(self, examples):
+        return self.tokenizer(examples['text'], **self.tokenize_settings)
 
-    @staticmethod
-    def tokenize_function(examples):
-        tokenizer = AutoTokenizer.from_pretrained("bert-base-uncased")
-        return tokenizer(examples['text'], padding="max_length", truncation=True)
+    def encode(self, data):
+        tokens = self.data_loader.tokens.encode(self.tokenizer, data['text'], **self.tokenize_settings)
+        return TokenDataset(tokens, data.get('label'))
 
     def train(self):
-        self.train_dataset = Dataset.from_pandas(pd.DataFrame(self.data_loader.train_data))
-        self.encoded_train_dataset = self.train_dataset.map(self.tokenize_function, batched=True)
+        self.encoded_train_dataset = self.encode(self.data_loader.train_data)
         print(self.encoded_train_dataset)
-        self.test_dataset = Dataset.from_pandas(pd.DataFrame(self.data_loader.test_data))
-        print(self.test_dataset)
-        self.encoded_test_dataset = self.test_dataset.map(self.tokenize_function, batched=True)
-        self.trainer = UnbalancedLossTrainer(model=self.model, args=self.training_args, train_dataset=self.encoded_train_dataset,
+        self.encoded_test_dataset = self.encode(self.data_loader.test_data)
+        self.trainer = UnbalancedLossTrainer(model=self.model, args=self.training_args, data_collator=self.collator, train_dataset=self.encoded_train_dataset,
                                eval_dataset=self.encoded_test_dataset, compute_metrics=self.compute_metrics)
 
         self.trainer.train()
@@ -78,20 +82,17 @@ class BertBaseUncasedWithTrainer:
         self.model.save_pretrained(os.path.join(self.data_loader.storage_folder, "output"))
 
     def predict(self):
-        self.test_dataset = Dataset.from_pandas(pd.DataFrame(self.data_loader.test_data))
-        print(self.test_dataset)
-        self.encoded_test_dataset = self.test_dataset.map(self.tokenize_function, batched=True)
-        self.trainer = UnbalancedLossTrainer(model=self.model, args=self.training_args,
+        self.encoded_test_dataset = self.encode(self.data_loader.test_data)
+        self.trainer = UnbalancedLossTrainer(model=self.model, args=self.training_args, data_collator=self.collator,
                                eval_dataset=self.encoded_test_dataset, compute_metrics=self.compute_metrics)
 
         result = self.trainer.evaluate()
         print(result)
 
     def final(self):
-        self.final_dataset = Dataset.from_pandas(pd.DataFrame(self.data_loader.final_data))
-        self.encoded_final_dataset = self.final_dataset.map(self.tokenize_function, batched=True)
+        self.encoded_final_dataset = self.encode(self.data_loader.final_data)
         print(self.encoded_final_dataset)
-        self.trainer = UnbalancedLossTrainer(model=self.model, args=self.training_args)
+        self.trainer = UnbalancedLossTrainer(model=self.model, args=self.training_args, data_collator=self.collator)
         self.prediction, _, _ = self.trainer.predict(test_dataset=self.encoded_final_dataset)
         print(self.prediction)
         self.prediction = np.argmax(self.prediction, axis=-1)
@@ -1,16 +1,25 @@
 from loader.base import BaseLoader
-from transformers import BertForSequenceClassification, AdamW, BertConfig, RobertaTokenizer, RobertaModel, TrainingArguments, Trainer
-from datasets import Dataset, load_metric
+from util.metrics import compute_metrics
+from model.tokenization import load_tokenizer
+from model.batching import TokenDataset, default_workers
+from transformers import BertForSequenceClassification, AdamW, BertConfig, RobertaTokenizer, RobertaModel, TrainingArguments, Trainer, \
+    DataCollatorWithPadding
 import numpy as np
 import pandas as pd
 import os
+from functools import cached_property
 
 
 class RoBERTaBase:
-    precision_metric = load_metric("precision")
-    recall_metric = load_metric("recall")
-    f1_metric = load_metric("f1")
-    tokenizer = RobertaTokenizer.from_pretrained("roberta-base")
+    tokenize_settings = dict(truncation=True)
+
+    @cached_property
+    def tokenizer(self):
+        return load_tokenizer("roberta-base", RobertaTokenizer)
+
+    @cached_property
+    def collator(self):
+        return DataCollatorWithPadding(self.tokenizer)
 
     def __init__(self, loader: BaseLoader, load_existing=False):
         self.data_loader = loader
@@ -21,6 +30,8 @@ class RoBERTaBase:
                                                load_best_model_at_end=True,
                                                evaluation_strategy="epoch",
                                                save_strategy="epoch",
+                                               group_by_length=True,
+                                               dataloader_num_workers=default_workers(),
                                                per_device_train_batch_size=4
                                                )
         model_name = "roberta-base"
@@ -38,28 +49,20 @@ class RoBERTaBase:
         )
         self.model.cuda()
 
-    @staticmethod
-    def compute_metrics(eval_pred):
-        logits, labels = eval_pred
-        predictions = np.argmax(logits, axis=-1)
+    compute_metrics = staticmethod(compute_metrics)
 
-        precision = RoBERTaBase.precision_metric.compute(predictions=predictions, references=labels)["precision"]
-        recall = RoBERTaBase.recall_metric.compute(predictions=predictions, references=labels)["recall"]
-        f1 = RoBERTaBase.f1_metric.compute(predictions=predictions, references=labels)["f1"]
-        return {"precision": precision, "recall": recall, "f1": f1}
+    def tokenize_function(self, examples):
+        return self.tokenizer(examples['text'], **self.tokenize_settings)
 
-    @staticmethod
-    def tokenize_function(examples):
-        return RoBERTaBase.tokenizer(examples['text'], padding="max_length", truncation=True)
+    def encode(self, data):
+        tokens = self.data_loader.tokens.encode(self.tokenizer, data['text'], **self.tokenize_settings)
+        return TokenDataset(tokens, data.get('label'))
 
     def train(self):
-        self.train_dataset = Dataset.from_pandas(pd.DataFrame(self.data_loader.train_data))
-        self.encoded_train_dataset = self.train_dataset.map(self.tokenize_function, batched=True)
+        self.encoded_train_dataset = self.encode(self.data_loader.train_data)
         print(self.encoded_train_dataset)
-        self.test_dataset = Dataset.from_pandas(pd.DataFrame(self.data_loader.test_data))
-        print(self.test_dataset)
-        self.encoded_test_dataset = self.test_dataset.map(self.tokenize_function, batched=True)
-        self.trainer = Trainer(model=self.model, args=self.training_args, train_dataset=self.encoded_train_dataset,
+        self.encoded_test_dataset = self.encode(self.data_loader.test_data)
+        self.trainer = Trainer(model=self.model, args=self.training_args, data_collator=self.collator, train_dataset=self.encoded_train_dataset,
                                eval_dataset=self.encoded_test_dataset, compute_metrics=self.compute_metrics)
 
         self.trainer.train()
@@ -68,20 +71,17 @@ class RoBERTaBase:
         self.model.save_pretrained(os.path.join(self.data_loader.storage_folder, "output"))
 
     def predict(self):
-        self.test_dataset = Dataset.from_pandas(pd.DataFrame(self.data_loader.test_data))
-        print(self.test_dataset)
-        self.encoded_test_dataset = self.test_dataset.map(self.tokenize_function, batched=True)
-        self.trainer = Trainer(model=self.model, args=self.training_args,
+        self.encoded_test_dataset = self.encode(self.data_loader.test_data)
+        self.trainer = Trainer(model=self.model, args=self.training_args, data_collator=self.collator,
                                eval_dataset=self.encoded_test_dataset, compute_metrics=self.compute_metrics)
 
         result = self.trainer.evaluate()
         print(result)
 
     def final(self):
-        self.final_dataset = Dataset.from_pandas(pd.DataFrame(self.data_loader.final_data))
-        self.encoded_final_dataset = self.final_dataset.map(self.tokenize_function, batched=True)
+        self.encoded_final_dataset = self.encode(self.data_loader.final_data)
         print(self.encoded_final_dataset)
-        self.trainer = Trainer(model=self.model, args=self.training_args)
+        self.trainer = Trainer(model=self.model, args=self.training_args, data_collator=self.collator)
         self.prediction, _, _ = self.trainer.predict(test_dataset=self.encoded_final_dataset)
         print(self.prediction)
         self.prediction = np.argmax(self.prediction, axis=-1)
@@ -0,0 +1,163 @@
+import os
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler, SequentialSampler
+
+
+def default_workers():
+    # Leave a core to the training loop, a few workers are enough to keep the collation ahead of the GPU
+    return min(4, max(0, (os.cpu_count() or 1) - 1))
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler grouping examples of similar token length so that batches padded to their own longest
+    sequence carry little padding
+    The shuffled dataset is cut into pools of pool_batches batches, every pool is sorted by length and cut
+    into batches, and the batch order is shuffled again. Every iteration starts a new epoch with a new
+    shuffle. Without shuffling, the whole dataset is sorted by length, which suits evaluation loops.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, pool_batches=50, seed=0, drop_last=False):
+        """
+        :param lengths: token length of every example
+        :param batch_size: examples per batch
+        :param pool_batches: batches sorted together, larger pools pad less but shuffle less
+        """
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_batches = pool_batches
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    @classmethod
+    def from_dataset(cls, dataset, batch_size, shuffle=True, **kwargs):
+        """
+        :param dataset: TokenDataset, or tokenized datasets.Dataset with an input_ids column
+        """
+        if isinstance(dataset, TokenDataset):
+            return cls(dataset.tokens.lengths, batch_size, shuffle, **kwargs)
+        return cls([len(ids) for ids in dataset['input_ids']], batch_size, shuffle, **kwargs)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        """
+        :return: list of index arrays, one per batch, for the current epoch
+        """
+        if not self.shuffle:
+            order = np.argsort(self.lengths, kind='stable')
+            batches = [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+        else:
+            rng = np.random.default_rng((self.seed, self.epoch))
+            order = rng.permutation(len(self.lengths))
+            pool = self.batch_size * self.pool_batches
+            batches = []
+            for start in range(0, len(order), pool):
+                members = order[start:start + pool]
+                members = members[np.argsort(self.lengths[members], kind='stable')]
+                batches.extend(members[offset:offset + self.batch_size]
+                               for offset in range(0, len(members), self.batch_size))
+            batches = [batches[position] for position in rng.permutation(len(batches))]
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        self.epoch += 1
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        # Pools hold whole batches, so only the last batch of the dataset can be short
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return -(-len(self.lengths) // self.batch_size)
+
+
+class TokenDataset(Dataset):
+    """
+    Examples of a partition read from the token cache, see loader.tokens.TokenCache
+    """
+
+    def __init__(self, tokens, labels=None):
+        """
+        :param tokens: loader.tokens.Tokens of the partition texts
+        :param labels: labels aligned with the texts, a column of label vectors is stacked into a matrix
+        """
+        self.tokens = tokens
+        self.labels = None if labels is None else np.stack(list(labels))
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __repr__(self):
+        return f"TokenDataset(rows={len(self)}, tokens={self.tokens.lengths.sum()}, labels={self.labels is not None})"
+
+    def __getitem__(self, index):
+        input_ids = self.tokens[index]
+        example = {'input_ids': input_ids, 'attention_mask': np.ones(len(input_ids), dtype=np.int64)}
+        if self.labels is not None:
+            example['label'] = self.labels[index]
+        return example
+
+
+class PaddingCollator:
+    """
+    collate_fn padding a list of tokenized examples to the longest sequence of the batch
+    :return: dict with (B, L) input_ids and attention_mask tensors, and the label tensor when present
+    """
+    sequence_keys = ['input_ids', 'attention_mask', 'token_type_ids']
+
+    def __init__(self, pad_token_id=0, padding_side='right'):
+        self.pad_token_id = pad_token_id or 0
+        self.padding_side = padding_side
+
+    def __call__(self, examples):
+        width = max(len(example['input_ids']) for example in examples)
+        batch = {}
+        for key in self.sequence_keys:
+            if key not in examples[0]:
+                continue
+            padding = self.pad_token_id if key == 'input_ids' else 0
+            padded = np.full((len(examples), width), padding, dtype=np.int64)
+            for row, example in enumerate(examples):
+                values = example[key]
+                if self.padding_side == 'left':
+                    padded[row, width - len(values):] = values
+                else:
+                    padded[row, :len(values)] = values
+            batch[key] = torch.from_numpy(padded)
+        if 'label' in examples[0]:
+            labels = np.asarray([example['label'] for example in examples])
+            batch['label'] = torch.from_numpy(labels.astype(np.float32) if labels.dtype == np.float64 else labels)
+        return batch
+
+
+def batch_loader(dataset, batch_size, collator, shuffle=True, sampling='bucket', workers=None, pin_memory=None,
+                 prefetch_factor=2, persistent=False):
+    """
+    DataLoader shared by the model classes
+    Batches are collated into (B, L) tensors by worker processes that prefetch ahead of the loop, into
+    pinned memory when a GPU is present so that .cuda(non_blocking=True) copies asynchronously.
+    :param collator: collate_fn, PaddingCollator for the hand-written loops
+    :param shuffle: shuffle the buckets, evaluation loops pass False to sort by length
+    :param sampling: 'bucket' for LengthBucketSampler, 'sequential' keeps the dataset order, needed when
+                     rows are stored aligned with card ids
+    :param workers: collating processes, default_workers() by default
+    :param persistent: keep the workers alive between iterations, for the train loader iterated every epoch.
+                       Every persistent loader holds its workers and their copy of the dataset until released.
+    """
+    workers = default_workers() if workers is None else workers
+    options = dict(collate_fn=collator, num_workers=workers,
+                   pin_memory=torch.cuda.is_available() if pin_memory is None else pin_memory)
+    if workers > 0:
+        options.update(persistent_workers=persistent, prefetch_factor=prefetch_factor)
+    if sampling == 'sequential':
+        return DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=batch_size, **options)
+    return DataLoader(dataset, batch_sampler=LengthBucketSampler.from_dataset(dataset, batch_size, shuffle), **options)
+
@@ -0,0 +1,73 @@
+import numpy as np
+import torch
+
+
+class Decision:
+    """
+    Turn a batch of logits into predictions with vectorized operations on the logits' device
+    Multi-label predictions keep the labels whose score is above a scalar or per-label threshold,
+    optionally restricted to the top k labels of every row.
+    """
+
+    def __init__(self, activation='sigmoid', threshold=0.5, top_k=None):
+        """
+        :param activation: 'sigmoid', 'softmax' or None to threshold raw logits
+        :param threshold: scalar or (num_labels, ) vector, labels scoring above it are predicted
+        :param top_k: keep at most k labels per row
+        """
+        self.activation = activation
+        self.threshold = threshold
+        self.top_k = top_k
+        self.device_threshold = None
+
+    def scores(self, logits):
+        logits = logits.float()
+        if self.activation == 'sigmoid':
+            return torch.sigmoid(logits)
+        if self.activation == 'softmax':
+            return torch.softmax(logits, dim=-1)
+        return logits
+
+    def threshold_on(self, device):
+        if self.device_threshold is None or self.device_threshold.device != device:
+            self.device_threshold = torch.as_tensor(np.asarray(self.threshold), dtype=torch.float32, device=device)
+        return self.device_threshold
+
+    def __call__(self, logits):
+        """
+        :param logits: (B, num_labels) tensor
+        :return: (B, num_labels) boolean tensor on the logits' device
+        """
+        scores = self.scores(logits)
+        mask = scores > self.threshold_on(scores.device)
+        if self.top_k is not None and self.top_k < scores.shape[-1]:
+            top = scores.topk(self.top_k, dim=-1).indices
+            mask &= torch.zeros_like(mask).scatter_(-1, top, True)
+        return mask
+
+    @staticmethod
+    def classes(logits):
+        """
+        :return: (B, ) arg max class of every row, on the logits' device
+        """
+        return logits.argmax(dim=-1)
+
+    @staticmethod
+    def bitmask(mask):
+        """
+        Pack a boolean prediction mask into bytes laid out like loader.tags.pack_requirements
+        :return: (B, ceil(num_labels / 8)) uint8 tensor
+        """
+        mask = mask.to(torch.uint8)
+        mask = torch.nn.functional.pad(mask, (0, -mask.shape[-1] % 8))
+        weights = torch.tensor([1 << bit for bit in range(8)], dtype=torch.uint8, device=mask.device)
+        return (mask.view(mask.shape[0], -1, 8) * weights).sum(dim=-1, dtype=torch.uint8)
+
+    @staticmethod
+    def tag_ids(mask):
+        """
+        :return: one list of predicted label ids per row
+        """
+        rows, columns = mask.nonzero(as_tuple=True)
+        counts = torch.bincount(rows, minlength=mask.shape[0]).cpu().numpy()
+        return [ids.tolist() for ids in np.split(columns.cpu().numpy(), np.cumsum(counts)[:-1])]
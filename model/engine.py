@@ -0,0 +1,343 @@
+import os
+import math
+import logging
+import time
+import numpy as np
+import torch
+import tqdm
+from functools import cached_property
+from transformers import get_linear_schedule_with_warmup
+from loader.base import BaseLoader
+from loader.tags import registry
+from util.metrics import compute_metrics
+from model.decision import Decision
+from model.evaluation import EvalAccumulator
+from model.tokenization import load_tokenizer
+from model.batching import PaddingCollator, TokenDataset, batch_loader
+
+
+def layer_wise_parameters(model, model_init_lr, multiplier, classifier_lr, layers=12):
+    """
+    Optimizer parameter groups with a learning rate decaying from the top encoder layer down
+    :param model_init_lr: learning rate of the top layer
+    :param multiplier: decay applied from one layer to the one below
+    :param classifier_lr: learning rate of the layer norm, linear and pooling parameters of the head
+    """
+    parameters = []
+    lr = model_init_lr
+    for layer in range(layers, -1, -1):
+        parameters.append({
+            'params': [p for n, p in model.named_parameters() if f'encoder.layer.{layer}.' in n],
+            'lr': lr
+        })
+        lr *= multiplier
+    parameters.append({
+        'params': [p for n, p in model.named_parameters() if 'layer_norm' in n or 'linear' in n or 'pooling' in n],
+        'lr': classifier_lr
+    })
+    return parameters
+
+
+class Engine:
+    """
+    Train, evaluation and prediction loop shared by the fine-tuned sequence classifiers
+    A model is a spec: a subclass sets the checkpoint, model class, tokenizer class and hyperparameters below
+    and the engine owns the rest. The tokenizer is loaded on first use, importing a spec loads nothing.
+    Batches are collated by batch_loader and moved to the device asynchronously, gradients can be accumulated
+    over several batches, and evaluate streams per-label confusion counts on the device with
+    EvalAccumulator.count instead of collecting its outputs.
+    Numerics are those of the original loops: float32 weights train in float32 unless a spec opts into
+    mixed_precision, float16 autocast with a gradient scaler on the GPU.
+    Without eval_while_training the model is evaluated after every epoch and saved to output once trained,
+    with it the model is also evaluated every eval_step_size batches and every evaluation is saved as a checkpoint.
+    """
+    pretrained = None
+    model_class = None
+    model_options = dict(num_labels=2, output_attentions=False, output_hidden_states=False)
+    # Slow tokenizer class of the checkpoint, the fast one is preferred by load_tokenizer
+    tokenizer_class = None
+    # Checkpoint of the tokenizer when it differs from pretrained
+    tokenizer_name = None
+    tokenizer_options = dict()
+    tokenize_settings = dict(add_special_tokens=True, max_length=512, truncation=True)
+    train_epochs = 3
+    batch_size = 4
+    accumulation_steps = 1
+    learning_rate = 2e-5
+    eps = 1e-4
+    # (multiplier, classifier_lr) of layer_wise_parameters, None trains every parameter at learning_rate
+    layer_decay = None
+    max_grad_norm = 1.0
+    # float16 weights
+    half = False
+    # float16 autocast and gradient scaling of float32 weights on the GPU
+    mixed_precision = False
+    eval_while_training = False
+    eval_step_size = 700
+    multi_label = False
+    # Threshold of final_with_threshold on the raw logits of binary models
+    threshold = 0.5
+    final_enabled = True
+
+    def __init__(self, loader: BaseLoader, load_existing=False, skip_eval=False, save_prob=False,
+                 half_precision=None):
+        """
+        :param load_existing: load the model trained into the output folder instead of the pretrained one
+        :param skip_eval: skip the evaluations of the training loop
+        :param save_prob: store the logits of predict and final
+        :param half_precision: overrides half
+        """
+        self.data_loader = loader
+        self.save_prob = save_prob
+        self.skip_eval = skip_eval
+        if self.skip_eval:
+            logging.info("Skipping eval phase.")
+        if half_precision is not None:
+            self.half = half_precision
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        model_name = self.pretrained_name()
+        local_files_only = False
+        if load_existing:
+            model_name = os.path.join(self.data_loader.storage_folder, "output")
+            local_files_only = True
+        self.checkpoint = model_name
+        self.model = self.model_class.from_pretrained(model_name, local_files_only=local_files_only,
+                                                      **self.model_options)
+        if self.half:
+            self.model.half()
+        self.model.to(self.device)
+        # Gradients of float16 weights cannot be unscaled, those train without autocast as before
+        self.amp = self.mixed_precision and not self.half and self.device.type == 'cuda'
+        self.scaler = torch.amp.GradScaler('cuda', enabled=self.amp)
+        self.collator = PaddingCollator(self.tokenizer.pad_token_id, self.tokenizer.padding_side)
+        self.final_loader = None
+
+        self.thresholds = None
+        if self.multi_label:
+            threshold_path = os.path.join(self.data_loader.storage_folder, "output", self.data_loader.threshold_filename)
+            if load_existing and os.path.isfile(threshold_path):
+                self.thresholds = np.load(threshold_path)
+            self.decision = Decision('sigmoid', 0.5 if self.thresholds is None else self.thresholds)
+        else:
+            self.decision = Decision(activation=None, threshold=self.threshold)
+        self.optimizer = self.create_optimizer()
+
+    compute_metrics = staticmethod(compute_metrics)
+
+    @cached_property
+    def tokenizer(self):
+        return load_tokenizer(self.tokenizer_name or self.pretrained, self.tokenizer_class, **self.tokenizer_options)
+
+    def pretrained_name(self):
+        return self.pretrained
+
+    def create_optimizer(self):
+        parameters = self.model.parameters()
+        if self.layer_decay is not None:
+            multiplier, classifier_lr = self.layer_decay
+            parameters = layer_wise_parameters(self.model, self.learning_rate, multiplier, classifier_lr)
+        # The fused kernel updates every parameter in one launch
+        return torch.optim.AdamW(parameters, lr=self.learning_rate, eps=self.eps, weight_decay=0.0,
+                                 fused=self.device.type == 'cuda')
+
+    def tokenize_function(self, examples):
+        return self.tokenizer(examples['text'], **self.tokenize_settings)
+
+    def encode(self, data):
+        tokens = self.data_loader.tokens.encode(self.tokenizer, data['text'], **self.tokenize_settings)
+        return TokenDataset(tokens, data.get('label'))
+
+    def forward(self, data, labels=True):
+        """
+        :param data: batch of PaddingCollator
+        :param labels: pass the labels to get the loss
+        """
+        inputs = dict(input_ids=data['input_ids'].to(self.device, non_blocking=True),
+                      attention_mask=data['attention_mask'].to(self.device, non_blocking=True))
+        if labels:
+            inputs['labels'] = data['label'].to(self.device, non_blocking=True)
+        with torch.autocast(self.device.type, dtype=torch.float16, enabled=self.amp):
+            return self.model(token_type_ids=None, return_dict=True, **inputs)
+
+    def eval_predictions(self, logits):
+        """
+        :return: predictions scored by data_loader.eval, logits of every label or the class of every row
+        """
+        return logits if self.multi_label else Decision.classes(logits)
+
+    def train(self):
+        self.encoded_train_dataset = self.encode(self.data_loader.train_data)
+        self.encoded_test_dataset = self.encode(self.data_loader.test_data)
+        logging.info(f"Training on {len(self.encoded_train_dataset)} texts")
+        self.train_loader = batch_loader(self.encoded_train_dataset, self.batch_size, self.collator, persistent=True)
+        self.test_loader = batch_loader(self.encoded_test_dataset, self.batch_size, self.collator, shuffle=False)
+        batches = len(self.train_loader)
+        self.total_steps = math.ceil(batches / self.accumulation_steps) * self.train_epochs
+        self.scheduler = get_linear_schedule_with_warmup(self.optimizer,
+                                                         num_warmup_steps=0,
+                                                         num_training_steps=self.total_steps)
+
+        for epoch in range(self.train_epochs):
+            self.model.train()
+            self.optimizer.zero_grad(set_to_none=True)
+            with tqdm.tqdm(self.train_loader, unit="batch") as tepoch:
+                for i, data in enumerate(tepoch):
+                    loss = self.forward(data).loss
+                    self.scaler.scale(loss / self.accumulation_steps).backward()
+                    if (i + 1) % self.accumulation_steps == 0 or i + 1 == batches:
+                        self.step()
+                    if i % 5 == 0:
+                        tepoch.set_description(f"Epoch {epoch}")
+                        tepoch.set_postfix(Loss=loss.item())
+                    if self.eval_while_training and i % self.eval_step_size == 0 and i != 0:
+                        self.checkpoint_step(epoch, i, "{}-{}".format(epoch, i))
+                        self.model.train()
+            self.checkpoint_step(epoch, batches, str(epoch))
+        if not self.eval_while_training:
+            self.model.save_pretrained(os.path.join(self.data_loader.storage_folder, "output"))
+        if self.data_loader.incremental:
+            self.data_loader.commit_delta()
+
+    def step(self):
+        self.scaler.unscale_(self.optimizer)
+        torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.scheduler.step()
+        self.optimizer.zero_grad(set_to_none=True)
+
+    def checkpoint_step(self, epoch, step, name):
+        """
+        Evaluate, write the final predictions and, with eval_while_training, save the checkpoint
+        :param name: epoch or epoch-step, suffix of the checkpoint folder and of the final predictions
+        """
+        checkpoint = "checkpoint-{}".format(name) if self.eval_while_training else None
+        if not self.skip_eval:
+            self.evaluate(epoch, step, checkpoint)
+        self.final(name)
+        if checkpoint is not None:
+            self.model.save_pretrained(os.path.join(self.data_loader.storage_folder, "output", checkpoint))
+
+    def evaluate(self, epoch, step, checkpoint=None):
+        self.model.eval()
+        accumulator = EvalAccumulator(len(self.encoded_test_dataset))
+        with torch.inference_mode(), tqdm.tqdm(self.test_loader, unit="batch") as tepoch:
+            for i, data in enumerate(tepoch):
+                result = self.forward(data)
+                accumulator.add(result.loss)
+                accumulator.count(data['label'], self.eval_predictions(result.logits),
+                                  num_classes=None if self.multi_label else result.logits.shape[-1])
+                if i % 5 == 0:
+                    tepoch.set_description(f"Evaluation {epoch}")
+                    tepoch.set_postfix(Loss=result.loss.item())
+        self.data_loader.log_context(model=type(self).__name__, epoch=epoch, step=step, checkpoint=checkpoint)
+        return self.data_loader.eval_counts(accumulator.counts())
+
+    def predict(self):
+        self.encoded_test_dataset = self.encode(self.data_loader.test_data)
+        # Stored logits are aligned with the ids of test_data
+        self.test_loader = batch_loader(self.encoded_test_dataset, self.batch_size, self.collator, shuffle=False,
+                                        sampling='sequential' if self.save_prob else 'bucket')
+        self.model.eval()
+        rows = len(self.encoded_test_dataset)
+        buffers = None
+        if self.save_prob and self.multi_label:
+            # Logits and labels are copied straight into preallocated memory-mapped files
+            num_labels = self.model.config.num_labels
+            prob_writer, label_writer = self.data_loader.prob_writers(rows, num_labels, num_labels)
+            buffers = {'predictions': prob_writer.array, 'labels': label_writer.array}
+        accumulator = EvalAccumulator(rows, buffers)
+        start = time.perf_counter()
+        with torch.inference_mode(), tqdm.tqdm(self.test_loader, unit="batch") as tepoch:
+            for i, data in enumerate(tepoch):
+                result = self.forward(data)
+                outputs = dict(labels=data['label'], predictions=self.eval_predictions(result.logits))
+                if self.save_prob and not self.multi_label:
+                    outputs['logits'] = result.logits
+                accumulator.add(result.loss, **outputs)
+                if i % 5 == 0:
+                    tepoch.set_description("Prediction")
+                    tepoch.set_postfix(Loss=result.loss.item())
+        labels, predictions = accumulator.result()
+        seconds = time.perf_counter() - start
+        self.data_loader.log_context(model=type(self).__name__, checkpoint=self.checkpoint, epoch=None, step=None)
+        if self.thresholds is not None:
+            # Per-tag thresholds apply to probabilities
+            predictions = 1 / (1 + np.exp(-predictions)) > self.thresholds
+        self.data_loader.eval(labels, predictions)
+        if self.save_prob and self.multi_label:
+            for writer in [prob_writer, label_writer]:
+                writer.advance(len(accumulator))
+                writer.close()
+            self.data_loader.prob_manifest(type(self).__name__, self.checkpoint, self.data_loader.test_data['id'],
+                                           seconds)
+        elif self.save_prob:
+            self.data_loader.prob(labels, accumulator['logits'], model=type(self).__name__,
+                                  checkpoint=self.checkpoint, seconds=seconds)
+
+    def final_predictions(self, logits, decision=None):
+        """
+        :return: predictions written by data_loader.final, tags packed like the loader's label matrix or
+                 the class of every row
+        """
+        if self.multi_label:
+            return Decision.bitmask((decision or self.decision)(logits))
+        if decision is None:
+            return Decision.classes(logits)
+        return decision(logits)[:, 1].double()
+
+    def final(self, epoch_num=''):
+        self.run_final(epoch_num)
+
+    def final_with_threshold(self, epoch_num='', threshold=None):
+        """
+        :param threshold: scalar or per tag threshold, the one of the spec or loaded with the model by default
+        """
+        if threshold is None:
+            decision = self.decision
+        else:
+            decision = Decision('sigmoid' if self.multi_label else None, threshold)
+        self.run_final(epoch_num, decision)
+
+    def run_final(self, epoch_num, decision=None):
+        if not self.final_enabled:
+            return
+        if self.final_loader is None:
+            # final runs after every evaluation of the training loop, the final data is encoded once
+            self.encoded_final_dataset = self.encode(self.data_loader.final_data)
+            self.final_loader = batch_loader(self.encoded_final_dataset, self.batch_size, self.collator,
+                                             sampling='sequential')
+        self.model.eval()
+        accumulator = EvalAccumulator(len(self.encoded_final_dataset))
+        with torch.inference_mode(), tqdm.tqdm(self.final_loader, unit="batch") as tepoch:
+            tepoch.set_description("Final")
+            for data in tepoch:
+                logits = self.forward(data, labels=False).logits
+                outputs = dict(predictions=self.final_predictions(logits, decision))
+                if self.save_prob:
+                    outputs['logits'] = logits
+                accumulator.add(**outputs)
+        predictions = accumulator['predictions']
+        self.prediction = predictions
+        self.data_loader.final(predictions, epoch_num)
+        if self.save_prob:
+            self.data_loader.final_prob(accumulator['logits'])
+
+    def test(self, data):
+        """
+        Log the predictions of one text
+        :param data: dict with a 'text'
+        """
+        self.model.eval()
+        data = self.tokenize_function(data)
+        with torch.inference_mode():
+            logits = self.model(torch.tensor(data['input_ids']).unsqueeze(0).to(self.device),
+                                token_type_ids=None,
+                                attention_mask=torch.tensor(data['attention_mask']).unsqueeze(0).to(self.device),
+                                return_dict=True).logits
+        if self.multi_label:
+            probs = torch.sigmoid(logits.float()).cpu().numpy()
+            predicted = registry.decode(probs, threshold=self.thresholds)[0]
+            logging.info("Predictions: " + ", ".join(f"{name}: {prob:.4f}" for name, prob in predicted))
+        else:
+            logging.info(f"Predictions: {torch.softmax(logits.float(), dim=-1).cpu().numpy()[0]}")
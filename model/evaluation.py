@@ -0,0 +1,122 @@
+import numpy as np
+import torch
+from util.metrics import ConfusionCounts
+
+
+class EvalAccumulator:
+    """
+    Collect the outputs of an evaluation loop into buffers preallocated for the whole dataset
+    Every named output of a batch is copied once into its host buffer, asynchronously from pinned memory
+    when it lives on the GPU, and the loss is summed on its device. Loops that only need scores stream
+    per-label confusion counts on the device with count instead of collecting the outputs. Nothing waits
+    for the device until the results are read.
+    """
+
+    def __init__(self, rows, buffers=None):
+        """
+        :param rows: number of rows the loop will produce, len(dataset)
+        :param buffers: optional dict of (rows, ...) numpy arrays to fill instead of allocating, e.g. the
+                        memory maps of loader.artifacts.ArrayWriter
+        """
+        self.rows = rows
+        self.buffers = {name: torch.from_numpy(array) for name, array in (buffers or {}).items()}
+        self.position = 0
+        self.loss_sum = None
+        self.batches = 0
+        self.pending = False
+        # (3, L) true positives, predicted positives and positives of every label or class id
+        self.confusion = None
+        self.class_ids = False
+
+    def allocate(self, values):
+        return torch.empty((self.rows, ) + tuple(values.shape[1:]), dtype=values.dtype,
+                           pin_memory=values.is_cuda)
+
+    def add(self, loss=None, **batch):
+        """
+        :param loss: scalar loss tensor of the batch
+        :param batch: (B, ...) tensors or arrays to collect, e.g. labels=..., predictions=..., logits=...
+        """
+        size = None
+        for name, values in batch.items():
+            values = torch.as_tensor(values).detach()
+            if name not in self.buffers:
+                self.buffers[name] = self.allocate(values)
+            size = len(values)
+            self.buffers[name][self.position:self.position + size].copy_(values, non_blocking=True)
+            self.pending |= values.is_cuda
+        if size is not None:
+            self.position += size
+        if loss is not None:
+            loss = loss.detach().float()
+            self.loss_sum = loss if self.loss_sum is None else self.loss_sum + loss
+            self.batches += 1
+
+    def count(self, labels, predictions, threshold=0.5, num_classes=None):
+        """
+        Add the confusion counts of one batch on the device of its predictions
+        :param labels: (B, L) 0/1 matrix or (B, ) class ids
+        :param predictions: scores of the same shape, binarized at threshold like ConfusionCounts.from_dense
+        :param num_classes: number of class ids, read from the batch when missing which waits for the device
+        """
+        predictions = torch.as_tensor(predictions).detach()
+        labels = torch.as_tensor(labels).detach().to(predictions.device, non_blocking=True)
+        predicted = predictions >= threshold
+        if labels.dim() == 1:
+            # Class ids are counted one-vs-rest, column c holds class id c
+            self.class_ids = True
+            if num_classes is None:
+                num_classes = int(max(labels.max().item(), predicted.max().item())) + 1 if len(labels) else 0
+            ids = torch.arange(num_classes, device=predictions.device)
+            actual = labels.long()[:, None] == ids
+            predicted = predicted.long()[:, None] == ids
+        else:
+            actual = labels.bool()
+        confusion = torch.stack([(actual & predicted).sum(dim=0), predicted.sum(dim=0), actual.sum(dim=0)])
+        if self.confusion is None:
+            self.confusion = confusion
+            return
+        width = max(confusion.shape[1], self.confusion.shape[1])
+        self.confusion = torch.nn.functional.pad(self.confusion, (0, width - self.confusion.shape[1]))
+        self.confusion[:, :confusion.shape[1]] += confusion
+
+    def __len__(self):
+        return self.position
+
+    def synchronize(self):
+        if self.pending and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.pending = False
+
+    @property
+    def loss(self):
+        """
+        Mean loss of the batches seen so far
+        """
+        if self.loss_sum is None:
+            return 0.0
+        return self.loss_sum.item() / self.batches
+
+    def __getitem__(self, name):
+        """
+        :return: numpy view of the rows collected for one output
+        """
+        self.synchronize()
+        return self.buffers[name][:self.position].numpy()
+
+    def result(self, labels='labels', predictions='predictions'):
+        return self[labels], self[predictions]
+
+    def counts(self, threshold=0.5, labels='labels', predictions='predictions'):
+        """
+        :return: ConfusionCounts streamed by count, or computed from the collected rows when nothing was counted
+        """
+        if self.confusion is None:
+            return ConfusionCounts.from_dense(self[labels], self[predictions], threshold)
+        tp, predicted, support = self.confusion.cpu().numpy()
+        if self.class_ids:
+            # Only the classes seen in either the labels or the predictions are scored, like from_dense
+            classes = np.flatnonzero(predicted + support)
+            return ConfusionCounts(tp[classes], predicted[classes] - tp[classes], support[classes] - tp[classes],
+                                   classes)
+        return ConfusionCounts(tp, predicted - tp, support - tp)
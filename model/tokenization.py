@@ -0,0 +1,62 @@
+import logging
+from transformers import AutoTokenizer
+
+# Card texts exercising keywords, stats, markup, numbers and non ASCII names
+probe_texts = [
+    "Deal 3 damage to a minion. Battlecry: Draw a card.",
+    "<b>Taunt</b>. <b>Deathrattle:</b> Summon two 1/1 Whelps.",
+    "Give a friendly minion +2/+2 and \"Can't be targeted by spells or Hero Powers.\"",
+    "Spell Damage +1. Your spells cost (2) less this turn.",
+    "Discover a 10-Cost minion. If you're holding a Dragon, gain 5 Armor.",
+    "Élise Starseeker — shuffle the Golden Monkey into your deck… then Echo, Rush & Lifesteal!",
+    "[x]At the end of your turn, if you played 3+ cards, transform into Nozdormu's Hourglass.",
+    "",
+]
+
+
+def compare_tokenizers(first, second, texts=None, **settings):
+    """
+    :return: positions of the texts the two tokenizers encode into different ids
+    """
+    texts = probe_texts if texts is None else list(texts)
+    first_ids = first(texts, **settings)['input_ids']
+    second_ids = second(texts, **settings)['input_ids']
+    return [position for position, (left, right) in enumerate(zip(first_ids, second_ids)) if left != right]
+
+
+# Positions of the probe_texts the fast and slow tokenizers disagree on, per checkpoint, class and options
+verified = {}
+
+
+def load_tokenizer(name, slow_class, verify=True, **kwargs):
+    """
+    Prefer the Rust-backed fast tokenizer of a checkpoint over its Python implementation
+    The fast tokenizer is only used when it exists or can be converted and, with verify, when it encodes
+    probe_texts into exactly the ids of the slow one. The comparison runs once per checkpoint and process,
+    later loads reuse its result in verified. Slow tokenizers are parallelized by
+    loader.tokens.tokenize_texts instead.
+    :param name: checkpoint name or local folder
+    :param slow_class: Python tokenizer class of the checkpoint, e.g. DebertaV2Tokenizer
+    :param kwargs: passed to from_pretrained of both tokenizers, e.g. do_lower_case
+    :return: tokenizer, is_fast tells which one was chosen
+    """
+    try:
+        fast = AutoTokenizer.from_pretrained(name, use_fast=True, **kwargs)
+    except (ValueError, OSError, ImportError) as error:
+        logging.warning(f"No fast tokenizer for {name}, using {slow_class.__name__}: {error}")
+        return slow_class.from_pretrained(name, **kwargs)
+    if not fast.is_fast:
+        logging.warning(f"No fast tokenizer for {name}, using {type(fast).__name__}")
+        return fast
+    if verify:
+        key = (name, slow_class.__name__, tuple(sorted(kwargs.items())))
+        slow = None
+        if key not in verified:
+            slow = slow_class.from_pretrained(name, **kwargs)
+            verified[key] = compare_tokenizers(fast, slow)
+        if verified[key]:
+            logging.warning(f"{type(fast).__name__} and {slow_class.__name__} disagree on {len(verified[key])} "
+                            f"probe texts of {name}, using {slow_class.__name__}")
+            return slow_class.from_pretrained(name, **kwargs) if slow is None else slow
+    logging.info(f"Using {type(fast).__name__} for {name}")
+    return fast
@@ -0,0 +1,121 @@
+import unittest
+import os
+import pickle
+import tempfile
+import numpy as np
+import pandas as pd
+import torch
+from unittest import mock
+from torch.utils.data import DataLoader
+from loader.tokens import TokenCache
+from model.batching import LengthBucketSampler, PaddingCollator, TokenDataset, batch_loader
+from util.benchmark import synthetic_examples, word_tokenizer, card_texts
+
+
+class BatchingTestCase(unittest.TestCase):
+    def test_bucket_sampler(self):
+        examples = synthetic_examples(1000)
+        lengths = [len(example['input_ids']) for example in examples]
+        sampler = LengthBucketSampler(lengths, 8, pool_batches=10)
+        first = list(sampler)
+        second = list(sampler)
+        self.assertEqual(len(first), len(sampler))
+        for epoch in [first, second]:
+            np.testing.assert_array_equal(np.sort(np.concatenate(epoch)), np.arange(1000))
+            self.assertTrue(all(len(batch) == 8 for batch in epoch))
+        self.assertNotEqual(first, second)
+        padded = sum(len(batch) * max(lengths[index] for index in batch) for batch in first)
+        self.assertLess(padded, 1.2 * sum(lengths))
+
+        ordered = list(LengthBucketSampler(lengths, 8, shuffle=False))
+        self.assertEqual([index for batch in ordered for index in batch], np.argsort(lengths, kind='stable').tolist())
+        self.assertEqual(len(list(LengthBucketSampler(lengths, 8, drop_last=True))), 1000 // 8)
+
+    def test_collator(self):
+        examples = [{'input_ids': [5, 6, 7], 'attention_mask': [1, 1, 1], 'label': 1, 'text': "a"},
+                    {'input_ids': [8], 'attention_mask': [1], 'label': 0, 'text': "b"}]
+        batch = PaddingCollator(pad_token_id=3)(examples)
+        self.assertEqual(batch['input_ids'].tolist(), [[5, 6, 7], [8, 3, 3]])
+        self.assertEqual(batch['attention_mask'].tolist(), [[1, 1, 1], [1, 0, 0]])
+        self.assertEqual(batch['label'].tolist(), [1, 0])
+        self.assertNotIn('text', batch)
+        batch = PaddingCollator(pad_token_id=3, padding_side='left')(examples)
+        self.assertEqual(batch['input_ids'].tolist(), [[5, 6, 7], [3, 3, 8]])
+        multi_label = PaddingCollator()([{'input_ids': [1], 'label': [0.0, 1.0]}, {'input_ids': [1, 2], 'label': [1.0, 0.0]}])
+        self.assertEqual(multi_label['label'].shape, (2, 2))
+
+    def test_token_cache(self):
+        with tempfile.TemporaryDirectory() as folder:
+            tokenizer = word_tokenizer(folder)
+            settings = dict(add_special_tokens=True, max_length=16, truncation=True)
+            texts = card_texts(300)
+            data = pd.DataFrame({'text': texts, 'label': list(np.eye(4, dtype=np.float32)[np.arange(300) % 4])})
+            cache = TokenCache(os.path.join(folder, "tokens"))
+
+            train = cache.encode(tokenizer, data.text[:200], **settings)
+            with mock.patch.object(TokenCache, 'tokenize', wraps=cache.tokenize) as tokenize:
+                test = cache.encode(tokenizer, data.text[150:], **settings)
+                self.assertEqual(len(tokenize.call_args[0][1]), 100)
+                everything = TokenCache(cache.folder).encode(tokenizer, data.text[::-1], **settings)
+                self.assertEqual(tokenize.call_count, 1)
+            expected = tokenizer(texts, **settings)['input_ids']
+            for tokens, rows in [(train, range(200)), (test, range(150, 300)), (everything, range(299, -1, -1))]:
+                self.assertEqual([tokens[position].tolist() for position in range(len(tokens))],
+                                 [expected[row] for row in rows])
+            np.testing.assert_array_equal(everything.lengths, [len(expected[row]) for row in range(299, -1, -1)])
+
+            other = cache.encode(tokenizer, data.text[:10], **dict(settings, max_length=8))
+            self.assertEqual(len(os.listdir(cache.folder)), 2)
+            self.assertTrue(all(len(other[position]) <= 8 for position in range(10)))
+
+            dataset = TokenDataset(test, data.label[150:])
+            loader = DataLoader(dataset, batch_sampler=LengthBucketSampler.from_dataset(dataset, 16),
+                                collate_fn=PaddingCollator(tokenizer.pad_token_id))
+            for batch in loader:
+                self.assertEqual(batch['input_ids'].shape, batch['attention_mask'].shape)
+                self.assertEqual(batch['label'].dtype, torch.float32)
+                self.assertEqual(batch['label'].shape[1], 4)
+            self.assertEqual(sum(len(batch['label']) for batch in loader), 150)
+
+    def test_batch_loader(self):
+        with tempfile.TemporaryDirectory() as folder:
+            tokenizer = word_tokenizer(folder)
+            settings = dict(add_special_tokens=True, max_length=512, truncation=True)
+            texts = card_texts(512)
+            labels = (np.random.default_rng(0).random((512, 128)) < 0.05).astype(np.float32)
+            tokens = TokenCache(os.path.join(folder, "tokens")).encode(tokenizer, texts, **settings)
+            segment = pickle.loads(pickle.dumps(tokens.segments[0]))
+            self.assertIsInstance(segment.input_ids, np.memmap)
+            dataset = TokenDataset(tokens, list(labels))
+            collator = PaddingCollator(tokenizer.pad_token_id)
+
+            loader = batch_loader(dataset, 8, collator, sampling='sequential', workers=1)
+            batches = list(loader)
+            for batch in batches:
+                self.assertEqual(batch['input_ids'].dtype, torch.int64)
+                self.assertEqual(batch['input_ids'].shape, batch['attention_mask'].shape)
+                self.assertEqual(batch['label'].dtype, torch.float32)
+                self.assertEqual(tuple(batch['label'].shape), (len(batch['input_ids']), 128))
+            np.testing.assert_array_equal(torch.cat([batch['label'] for batch in batches]).numpy(), labels)
+            self.assertEqual(batches[0]['input_ids'][0, :len(tokens[0])].tolist(), tokens[0].tolist())
+            self.assertEqual(len(list(batch_loader(dataset, 8, collator, workers=0))), 64)
+            # Only the train loader keeps its workers between epochs
+            self.assertFalse(batch_loader(dataset, 8, collator, workers=1).persistent_workers)
+            self.assertTrue(batch_loader(dataset, 8, collator, workers=1, persistent=True).persistent_workers)
+
+    def test_padded_tokens(self):
+        examples = synthetic_examples(128)
+        tokens = sum(len(example['input_ids']) for example in examples)
+        collator = PaddingCollator()
+        fixed = DataLoader(examples, batch_size=8, collate_fn=collator)
+        bucketed = DataLoader(examples, batch_sampler=LengthBucketSampler([len(example['input_ids']) for example in examples], 8),
+                              collate_fn=collator)
+        # Every row used to be padded to 512 tokens, util/benchmark.py times the model on both
+        padded = sum(data['input_ids'].numel() for data in bucketed)
+        self.assertEqual(sum(int(data['attention_mask'].sum()) for data in bucketed), tokens)
+        self.assertLess(padded, sum(data['input_ids'].numel() for data in fixed))
+        self.assertLess(padded, 0.25 * 512 * len(examples))
+
+
+if __name__ == '__main__':
+    unittest.main()
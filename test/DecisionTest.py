@@ -0,0 +1,88 @@
+import unittest
+import numpy as np
+import pandas as pd
+import torch
+from loader.tags import pack_requirements, unpack_requirements
+from model.decision import Decision
+from model.evaluation import EvalAccumulator
+from util.metrics import ConfusionCounts
+
+
+class DecisionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.logits = torch.randn((64, 128), generator=torch.Generator().manual_seed(0)) * 3
+
+    def test_threshold(self):
+        thresholds = np.linspace(0.05, 0.95, 128)
+        mask = Decision('sigmoid', thresholds)(self.logits)
+        expected = 1 / (1 + np.exp(-self.logits.numpy())) > thresholds
+        np.testing.assert_array_equal(mask.numpy(), expected)
+        np.testing.assert_array_equal(Decision(None, 0.0)(self.logits).numpy(), self.logits.numpy() > 0)
+
+    def test_top_k(self):
+        mask = Decision('sigmoid', 0.5, top_k=3)(self.logits)
+        self.assertTrue((mask.sum(dim=1) <= 3).all())
+        for row in range(len(mask)):
+            best = set(torch.topk(self.logits[row], 3).indices.tolist())
+            self.assertEqual(set(torch.nonzero(mask[row]).flatten().tolist()),
+                             {id for id in best if self.logits[row, id] > 0})
+
+    def test_compact_results(self):
+        mask = Decision('sigmoid', 0.7)(self.logits)
+        ids = Decision.tag_ids(mask)
+        self.assertEqual(len(ids), len(mask))
+        for row, row_ids in zip(mask, ids):
+            self.assertEqual(row_ids, torch.nonzero(row).flatten().tolist())
+        packed = Decision.bitmask(mask).numpy()
+        self.assertEqual(packed.shape, (64, 16))
+        np.testing.assert_array_equal(unpack_requirements(packed).astype(bool), mask.numpy())
+        raw = pd.Series(["".join(f"{id}:0~" for id in row_ids) for row_ids in ids])
+        np.testing.assert_array_equal(pack_requirements(raw), packed)
+
+    def test_accumulator(self):
+        labels = (torch.rand((64, 128), generator=torch.Generator().manual_seed(1)) < 0.1).float()
+        accumulator = EvalAccumulator(64)
+        for start in range(0, 64, 10):
+            accumulator.add(torch.tensor(float(start)), labels=labels[start:start + 10],
+                            predictions=Decision.bitmask(Decision('sigmoid')(self.logits[start:start + 10])),
+                            classes=Decision.classes(self.logits[start:start + 10]))
+        self.assertEqual(len(accumulator), 64)
+        self.assertAlmostEqual(accumulator.loss, np.mean(range(0, 64, 10)))
+        np.testing.assert_array_equal(accumulator['labels'], labels.numpy())
+        np.testing.assert_array_equal(accumulator['classes'], self.logits.argmax(dim=1).numpy())
+        np.testing.assert_array_equal(unpack_requirements(accumulator['predictions']), (self.logits > 0).numpy())
+        self.assertEqual(ConfusionCounts.from_packed(np.packbits(labels.numpy().astype(bool), axis=1, bitorder='little'),
+                                                     accumulator['predictions']).report(),
+                         ConfusionCounts.from_dense(labels.numpy(), self.logits.numpy(), 0.0).report())
+
+        rows = 20000
+        logits = torch.randn((rows, 128))
+        accumulator = EvalAccumulator(rows)
+        for batch in range(0, rows, 8):
+            accumulator.add(logits=logits[batch:batch + 8])
+        np.testing.assert_array_equal(accumulator['logits'], logits.numpy())
+
+    def test_streamed_counts(self):
+        labels = (torch.rand((64, 128), generator=torch.Generator().manual_seed(1)) < 0.1).float()
+        accumulator = EvalAccumulator(64)
+        for start in range(0, 64, 10):
+            accumulator.count(labels[start:start + 10], self.logits[start:start + 10], threshold=0.0)
+        self.assertEqual(len(accumulator), 0)
+        self.assertEqual(accumulator.counts().report(),
+                         ConfusionCounts.from_dense(labels.numpy(), self.logits.numpy(), 0.0).report())
+
+        # Class ids, the first batches only see class 0 in the labels
+        classes = self.logits.argmax(dim=1) % 2
+        targets = (torch.arange(64) >= 40).long()
+        for num_classes in [None, 2]:
+            accumulator = EvalAccumulator(64)
+            for start in range(0, 64, 10):
+                accumulator.count(targets[start:start + 10], classes[start:start + 10], num_classes=num_classes)
+            counts = accumulator.counts()
+            expected = ConfusionCounts.from_dense(targets.numpy(), classes.numpy())
+            np.testing.assert_array_equal(counts.classes, expected.classes)
+            self.assertEqual(counts.report(), expected.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
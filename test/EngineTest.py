@@ -0,0 +1,111 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+import torch
+from unittest import mock
+from transformers import BertConfig, BertForSequenceClassification, BertTokenizer
+from loader.official import OfficialLoader
+from model.engine import Engine, layer_wise_parameters
+from util.benchmark import word_tokenizer
+from test.LoaderTest import synthetic_cards
+from test.TagsTest import filename
+
+
+def tiny_spec(folder):
+    """
+    Spec of a two layer BERT saved in folder, trained the way DebertaV2XLarge is
+    """
+    class TinyBert(Engine):
+        pretrained = folder
+        model_class = BertForSequenceClassification
+        model_options = dict(num_labels=128, problem_type="multi_label_classification")
+        tokenizer_class = BertTokenizer
+        tokenize_settings = dict(add_special_tokens=True, max_length=32, truncation=True)
+        train_epochs = 2
+        batch_size = 8
+        accumulation_steps = 2
+        eval_while_training = True
+        eval_step_size = 6
+        multi_label = True
+    return TinyBert
+
+
+class EngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        data_dir = os.path.join(self.directory.name, "data")
+        os.mkdir(data_dir)
+        with open(os.path.join(data_dir, filename), "w") as f:
+            f.write("\n".join(synthetic_cards(120)) + "\n")
+        self.patches = [mock.patch.object(OfficialLoader, 'data_dir', data_dir),
+                        mock.patch.object(OfficialLoader, 'base_dir', os.path.join(self.directory.name, "runtime"))]
+        for patch in self.patches:
+            patch.start()
+        self.pretrained = os.path.join(self.directory.name, "pretrained")
+        os.mkdir(self.pretrained)
+        word_tokenizer(self.pretrained).save_pretrained(self.pretrained)
+        torch.manual_seed(0)
+        config = BertConfig(vocab_size=30, hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+                            intermediate_size=64, max_position_embeddings=64, num_labels=128)
+        BertForSequenceClassification(config).save_pretrained(self.pretrained)
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.directory.cleanup()
+
+    def test_train_predict(self):
+        loader = OfficialLoader("Engine")
+        loader.process()
+        loader.split()
+        model = tiny_spec(self.pretrained)(loader, save_prob=True)
+        model.train()
+        # 15 batches per epoch, one optimizer step every two of them
+        self.assertEqual(model.total_steps, 16)
+        self.assertEqual(model.scheduler.last_epoch, 16)
+        output = os.path.join(loader.storage_folder, "output")
+        self.assertEqual(sorted(os.listdir(output)), ["checkpoint-0", "checkpoint-0-12", "checkpoint-0-6",
+                                                      "checkpoint-1", "checkpoint-1-12", "checkpoint-1-6"])
+        self.assertEqual(model.prediction.shape, (len(loader.final_data), 16))
+        self.assertEqual(model.prediction.dtype, np.uint8)
+        loader.metrics.flush()
+        rows = loader.metrics.query(run="Engine", metric='weighted_f1')
+        self.assertEqual(rows.checkpoint.tolist()[-2:], ["checkpoint-1-12", "checkpoint-1"])
+
+        model.predict()
+        probs, labels = loader.load_prob()
+        self.assertEqual(probs.shape, (len(loader.test_data), 128))
+        np.testing.assert_array_equal(labels, np.stack(loader.test_data.label))
+
+    def test_incremental_commit(self):
+        loader = OfficialLoader("Incremental", incremental=True)
+        loader.process()
+        loader.split()
+        self.assertEqual(len(loader.delta.added), 120)
+        spec = tiny_spec(self.pretrained)
+        spec.train_epochs, spec.eval_while_training = 1, False
+        spec(loader, skip_eval=True).train()
+        # Training committed the snapshot, an unchanged dataset has nothing left to process
+        again = OfficialLoader("Incremental", incremental=True)
+        self.assertEqual(len(again.delta), 0)
+        self.assertEqual(len(again.final_data), 0)
+
+        path = os.path.join(OfficialLoader.data_dir, filename)
+        with open(path, "w") as f:
+            f.write("\n".join(synthetic_cards(120)[1:] + synthetic_cards(121)[120:]) + "\n")
+        changed = OfficialLoader("Incremental", incremental=True)
+        self.assertEqual(len(changed.delta.removed), 1)
+        self.assertEqual(len(changed.final_data), len(changed.delta.rows()))
+        self.assertFalse(changed.final_data['id'].isin(changed.delta.removed).any())
+
+    def test_layer_wise_parameters(self):
+        model = BertForSequenceClassification.from_pretrained(self.pretrained)
+        groups = layer_wise_parameters(model, 2e-5, 0.5, 1e-4, layers=1)
+        self.assertEqual([group['lr'] for group in groups], [2e-5, 1e-5, 1e-4])
+        # BERT names its norms LayerNorm, the head group only matches DeBERTa and RoBERTa style names
+        self.assertEqual([len(group['params']) for group in groups], [16, 16, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
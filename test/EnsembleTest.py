@@ -0,0 +1,67 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+from unittest import mock
+from loader.official import OfficialLoader
+from util.ensemble import Ensemble
+
+
+class EnsembleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.patch = mock.patch.object(OfficialLoader, 'base_dir', self.directory.name)
+        self.patch.start()
+        rng = np.random.default_rng(0)
+        self.rows = 2000
+        self.ids = np.array([f"SYN_{row}" for row in range(self.rows)])
+        rates = np.zeros((128, ))
+        rates[[1, 2, 3, 9, 22]] = [0.3, 0.2, 0.1, 0.05, 0.4]
+        self.labels = (rng.random((self.rows, 128)) < rates).astype(np.float32)
+        signal = (self.labels * 2 - 1) * 2
+        self.folders = []
+        # An accurate expensive model and two noisy cheap ones with independent errors
+        for name, noise, seconds, shuffle in [("XLarge", 1.5, 100.0, False), ("CheapA", 3.0, 10.0, True),
+                                              ("CheapB", 3.0, 12.0, False)]:
+            loader = OfficialLoader(name)
+            order = rng.permutation(self.rows) if shuffle else np.arange(self.rows)
+            logits = signal + rng.normal(0, noise, signal.shape)
+            loader.prob(self.labels[order], logits[order].astype(np.float32), model=name, ids=self.ids[order],
+                        seconds=seconds)
+            self.folders.append(loader.prob_folder)
+        self.loader = loader
+
+    def tearDown(self):
+        self.patch.stop()
+        self.directory.cleanup()
+
+    def test_alignment(self):
+        ensemble = Ensemble(self.loader, self.folders)
+        self.assertEqual(ensemble.names, ["XLarge", "CheapA", "CheapB"])
+        self.assertIsInstance(ensemble.logits[2], np.memmap)
+        np.testing.assert_array_equal(ensemble.labels, self.labels)
+        np.testing.assert_array_equal(ensemble.ids, self.ids)
+        scores, labels = ensemble.scores([1])
+        np.testing.assert_array_equal(labels, self.labels)
+        self.assertGreater(np.corrcoef(scores[0, :, 1], self.labels[:, 1])[0, 1], 0.3)
+
+    def test_blend(self):
+        ensemble = Ensemble(self.loader, self.folders)
+        valid, test = np.arange(1000), np.arange(1000, 2000)
+        weights = ensemble.fit(valid, [0, 1, 2])
+        self.assertAlmostEqual(weights.sum(), 1.0, places=5)
+        self.assertEqual(weights.argmax(), 0)
+        per_tag = ensemble.fit(valid, [1, 2], per_tag=True)
+        self.assertEqual(per_tag.shape, (2, 128))
+        self.assertEqual(ensemble.predict(test).shape, (1000, 128))
+
+        table = ensemble.compare(valid, test, baseline="XLarge")
+        self.assertEqual(len(table), 3 + 3 + 1)
+        cheap = table[table.members == "CheapA + CheapB"].iloc[0]
+        single = table[table.members == "CheapA"].iloc[0]
+        self.assertGreater(cheap.f1, single.f1)
+        self.assertAlmostEqual(cheap.relative_cost, 0.22)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,243 @@
+import unittest
+import os
+import sqlite3
+import tempfile
+import numpy as np
+import pandas as pd
+from unittest import mock
+from loader.tags import Tags
+from loader.official import OfficialLoader
+from util.runner import FoldRunner
+from util.store import MetricsStore
+from util.slices import card_slices, slice_table, prediction_slices
+from test.TagsTest import cards, filename
+
+
+def synthetic_cards(count, seed=0):
+    rng = np.random.default_rng(seed)
+    lines = []
+    for index in range(count):
+        tags = rng.choice([1, 2, 3, 9, 22], size=rng.integers(1, 3), replace=False).tolist()
+        if index % 40 == 0:
+            tags.append(60)
+        requirements = "".join(f"{tag}:0~" for tag in sorted(tags))
+        lines.append(f"Card {index}^SYN_{index}^Deal {index % 10} damage.^{requirements}^")
+    return lines
+
+
+def fold_scores(loader, train_index, valid_index, test_index):
+    import torch
+    return {'train': len(train_index), 'valid': len(valid_index), 'test': len(test_index),
+            'threads': torch.get_num_threads()}
+
+
+def failing_fold(loader, train_index, valid_index, test_index):
+    raise AssertionError("finished fold was run again")
+
+
+class LoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        data_dir = os.path.join(self.directory.name, "data")
+        os.mkdir(data_dir)
+        with open(os.path.join(data_dir, filename), "w") as f:
+            f.write("\n".join(cards) + "\n")
+        self.base_dir = os.path.join(self.directory.name, "runtime")
+        self.patches = [mock.patch.object(OfficialLoader, 'data_dir', data_dir),
+                        mock.patch.object(OfficialLoader, 'base_dir', self.base_dir)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.directory.cleanup()
+
+    def test_lazy_construction(self):
+        with mock.patch.object(Tags, 'load', side_effect=AssertionError("dataset loaded eagerly")):
+            loader = OfficialLoader("Lazy")
+        self.assertFalse(os.path.exists(self.base_dir))
+
+        self.assertEqual(len(loader.all_data), len(cards))
+        self.assertEqual(len(loader.label_matrix), len(cards))
+        self.assertFalse(os.path.exists(self.base_dir))
+        self.assertTrue(os.path.isdir(loader.ref_dir))
+        self.assertTrue(os.path.isdir(loader.res_dir))
+
+        loader.process()
+        self.assertEqual(len(loader.all_data), len(loader.label_matrix))
+        self.assertEqual(len(loader.final_data), len(cards))
+
+    def write_synthetic(self, count):
+        with open(os.path.join(OfficialLoader.data_dir, filename), "w") as f:
+            f.write("\n".join(synthetic_cards(count)) + "\n")
+
+    def test_split_shared(self):
+        loader = OfficialLoader("Split")
+        loader.process()
+        loader.split()
+        self.assertIs(loader.train_data, loader.test_data)
+        np.testing.assert_array_equal(loader.train_index, np.arange(len(loader.all_data)))
+        np.testing.assert_array_equal(np.stack(loader.train_data['label']), loader.dense_labels())
+
+    def test_split_stratified(self):
+        self.write_synthetic(400)
+        loader = OfficialLoader("Split")
+        loader.process()
+        loader.split(test_size=0.2, valid_size=0.2, seed=7)
+        partitions = [loader.train_index, loader.test_index, loader.valid_index]
+        np.testing.assert_array_equal(np.sort(np.concatenate(partitions)), np.arange(400))
+        for index, share in zip(partitions, [0.6, 0.2, 0.2]):
+            self.assertAlmostEqual(len(index) / 400, share, delta=0.02)
+            np.testing.assert_allclose(loader.dense_labels(index).sum(axis=0) / len(index),
+                                       loader.dense_labels().sum(axis=0) / 400, atol=0.02)
+            self.assertEqual(loader.dense_labels(index)[:, 60].sum(), 400 / 40 * share)
+        self.assertEqual(loader.test_data['id'].tolist(), loader.all_data.id[loader.test_index].tolist())
+
+        other = OfficialLoader("Split")
+        other.process()
+        other.split(test_size=0.2, valid_size=0.2, seed=7)
+        np.testing.assert_array_equal(other.test_index, loader.test_index)
+
+    def test_folds(self):
+        self.write_synthetic(400)
+        loader = OfficialLoader("Fold")
+        loader.process()
+        labels = loader.dense_labels()
+        tested = []
+        for train_index, test_index in loader.fold(5):
+            self.assertEqual(len(np.intersect1d(train_index, test_index)), 0)
+            self.assertEqual(len(train_index) + len(test_index), 400)
+            self.assertEqual(labels[test_index, 60].sum(), 2)
+            tested.append(test_index)
+        np.testing.assert_array_equal(np.sort(np.concatenate(tested)), np.arange(400))
+
+        folds = list(loader.nested_fold(4))
+        self.assertEqual(len(folds), 4 * 3)
+        for train_index, valid_index, test_index, j, i in folds:
+            self.assertEqual(len(np.union1d(np.union1d(train_index, valid_index), test_index)), 400)
+            self.assertEqual(len(train_index) + len(valid_index) + len(test_index), 400)
+            self.assertGreater(labels[valid_index, 60].sum(), 0)
+        encoded = np.arange(400) * 10
+        np.testing.assert_array_equal(loader.select(encoded, test_index), test_index * 10)
+
+    def test_fold_runner(self):
+        self.write_synthetic(120)
+        loader = OfficialLoader("Runner")
+        loader.process()
+        results = FoldRunner(loader, fold_scores, k=3, workers=2, threads_per_worker=1).run()
+        self.assertEqual(len(results), 3 * 2)
+        self.assertEqual(results[['outer', 'inner']].values.tolist(), [[j, i] for j in range(3) for i in range(2)])
+        self.assertTrue((results.train + results.valid + results.test == 120).all())
+        self.assertTrue((results.threads == 1).all())
+        resumed = FoldRunner(loader, failing_fold, k=3, workers=2).run()
+        self.assertTrue(resumed.equals(results))
+        # Another k splits the data differently and runs its own folds
+        self.assertEqual(len(FoldRunner(loader, fold_scores, k=2, workers=2, threads_per_worker=1).run()), 2)
+        with mock.patch.object(loader, 'nested_fold', return_value=iter([])):
+            empty = FoldRunner(loader, failing_fold, k=4, workers=2).run()
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(list(empty.columns), ['outer', 'inner', 'seconds'])
+
+    def test_prob_artifacts(self):
+        loader = OfficialLoader("Prob")
+        loader.process()
+        loader.split()
+        rows = len(loader.test_data)
+        logits = np.random.default_rng(0).normal(size=(rows, 128)).astype(np.float32)
+        labels = loader.dense_labels(loader.test_index)
+        prob_writer, label_writer = loader.prob_writers(rows, 128, 128)
+        for start in range(0, rows, 3):
+            prob_writer.write(logits[start:start + 3])
+        # Rows copied straight into the memory map are counted with advance
+        label_writer.array[:] = labels
+        label_writer.advance(rows)
+        with self.assertRaises(ValueError):
+            label_writer.advance(1)
+        prob_writer.close()
+        label_writer.close()
+        manifest = loader.prob_manifest("Synthetic", "checkpoint", loader.test_data['id'])
+        self.assertEqual(manifest['rows'], rows)
+
+        probs, stored_labels = loader.load_prob()
+        self.assertIsInstance(probs, np.memmap)
+        np.testing.assert_array_equal(probs, logits)
+        np.testing.assert_array_equal(stored_labels, labels)
+        ids = np.load(os.path.join(loader.prob_folder, manifest['ids']))
+        self.assertEqual(ids.tolist(), loader.test_data['id'].tolist())
+
+        loader.prob(labels[:, :2], logits[:, :2])
+        probs, stored_labels = loader.load_prob()
+        self.assertEqual(probs.shape, (rows, 2))
+
+    def test_prediction_slices(self):
+        self.write_synthetic(120)
+        loader = OfficialLoader("Slices")
+        loader.process()
+        loader.split()
+        rows = len(loader.test_data)
+        logits = np.random.default_rng(1).normal(size=(rows, 128)).astype(np.float32)
+        labels = loader.dense_labels(loader.test_index)
+        # Written the way Engine.predict stores a multi-label run
+        prob_writer, label_writer = loader.prob_writers(rows, 128, 128)
+        prob_writer.array[:] = logits
+        label_writer.array[:] = labels
+        for writer in [prob_writer, label_writer]:
+            writer.advance(rows)
+            writer.close()
+        manifest = loader.prob_manifest("Synthetic", "checkpoint", loader.test_data['id'])
+
+        expected = slice_table(labels, 1 / (1 + np.exp(-logits.astype(np.float64))),
+                               card_slices(loader.test_data, loader.label_matrix[loader.test_index]))
+        analysis = OfficialLoader("Analysis")
+        for folder in [loader.prob_folder, os.path.join(loader.prob_folder, loader.manifest_filename)]:
+            table = prediction_slices(analysis, folder)
+            pd.testing.assert_frame_equal(table, expected)
+        self.assertEqual(table[table.slice == 'length'].cards.sum(), manifest['rows'])
+
+    def test_metrics_store(self):
+        loader = OfficialLoader("Store")
+        loader.process()
+        loader.split()
+        labels = loader.dense_labels()
+        for epoch, noise in enumerate([0.8, 0.3, 0.5]):
+            scores = np.clip(labels + np.random.default_rng(epoch).normal(0, noise, labels.shape), 0, 1)
+            loader.log_context(model="Synthetic", epoch=epoch, step=10, checkpoint=f"checkpoint-{epoch}")
+            loader.eval(labels, scores)
+        loader.eval_per(labels[:4], labels[:4], 'length', '0-127')
+        other = OfficialLoader("Other")
+        other.eval(labels, np.zeros(labels.shape))
+        for store in [loader.metrics, other.metrics]:
+            store.flush()
+
+        rows = loader.metrics.query(run="Store", metric='weighted_f1')
+        self.assertEqual(rows.slice.tolist(), ['all', 'all', 'all', 'length'])
+        self.assertEqual(rows.epoch.tolist(), [0, 1, 2, 2])
+        self.assertFalse(os.path.exists(os.path.join(loader.storage_folder, "scorelength_0-127.txt")))
+        comparison = loader.metrics.compare('weighted_f1')
+        self.assertEqual(comparison.index.tolist(), ["Store", "Other"])
+        self.assertEqual(comparison.loc["Store", 'best_epoch'], 1)
+        self.assertEqual(comparison.loc["Store", 'evaluations'], 3)
+        self.assertEqual(comparison.loc["Other", 'best'], 0.0)
+        for store in [loader.metrics, other.metrics]:
+            store.close()
+
+    def test_metrics_store_errors(self):
+        path = os.path.join(self.directory.name, "store", "metrics.sqlite")
+        store = MetricsStore(path)
+        with mock.patch.object(MetricsStore, 'connect', side_effect=sqlite3.OperationalError("unable to open")):
+            with self.assertRaises(sqlite3.OperationalError):
+                store.append("Broken", {'f1': 1.0})
+        # A writer dying after the first connection fails flush and close instead of blocking them
+        with mock.patch.object(MetricsStore, 'connect',
+                               side_effect=[mock.MagicMock(), sqlite3.OperationalError("disk I/O error")]):
+            store.append("Broken", {'f1': 1.0})
+            with self.assertRaises(RuntimeError):
+                store.flush()
+        with self.assertRaises(RuntimeError):
+            store.close()
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import unittest
+import numpy as np
+from sklearn.metrics import precision_score, recall_score, f1_score
+from loader.tags import unpack_requirements
+from util.metrics import ConfusionCounts, compute_metrics
+from util.opt import threshold_curve, tag_thresholds
+from util.slices import card_slices, slice_table
+import pandas as pd
+
+
+def sklearn_scores(labels, predictions, average):
+    return (precision_score(labels, predictions, average=average, zero_division=0),
+            recall_score(labels, predictions, average=average, zero_division=0),
+            f1_score(labels, predictions, average=average, zero_division=0))
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        rates = rng.random(128) ** 4
+        self.labels = (rng.random((500, 128)) < rates).astype(np.float32)
+        self.scores = np.clip(self.labels * 0.6 + rng.normal(0.2, 0.25, self.labels.shape), 0, 1)
+
+    def test_multilabel_matches_sklearn(self):
+        scores = self.scores.copy()
+        counts = ConfusionCounts.from_dense(self.labels, scores, threshold=0.5)
+        np.testing.assert_array_equal(scores, self.scores)
+        predictions = (self.scores >= 0.5).astype(np.float32)
+        for average in ConfusionCounts.averages:
+            np.testing.assert_allclose(counts.score(average), sklearn_scores(self.labels, predictions, average))
+        per_label = sklearn_scores(self.labels, predictions, None)
+        for ours, theirs in zip(counts.per_label(), per_label):
+            np.testing.assert_allclose(ours, theirs)
+
+    def test_packed_matches_dense(self):
+        packed_labels = np.packbits(self.labels.astype(bool), axis=1, bitorder='little')
+        packed_predictions = np.packbits(self.scores >= 0.5, axis=1, bitorder='little')
+        np.testing.assert_array_equal(unpack_requirements(packed_labels), self.labels)
+        packed = ConfusionCounts.from_packed(packed_labels, packed_predictions)
+        dense = ConfusionCounts.from_dense(self.labels, self.scores)
+        self.assertEqual(packed.report(), dense.report())
+
+    def test_class_ids_match_sklearn(self):
+        rng = np.random.default_rng(1)
+        labels = rng.integers(0, 2, 300).astype(np.float64)
+        predictions = np.where(rng.random(300) < 0.8, labels, 1 - labels)
+        counts = ConfusionCounts.from_dense(labels, predictions)
+        for average in ConfusionCounts.averages:
+            np.testing.assert_allclose(counts.score(average), sklearn_scores(labels, predictions, average))
+
+    def test_batches_add_up(self):
+        total = ConfusionCounts.from_dense(self.labels[:200], self.scores[:200]) + \
+                ConfusionCounts.from_dense(self.labels[200:], self.scores[200:])
+        self.assertEqual(total.report(), ConfusionCounts.from_dense(self.labels, self.scores).report())
+
+    def test_threshold_curve(self):
+        rng = np.random.default_rng(2)
+        labels = rng.random(400) < 0.3
+        scores = np.round(np.clip(labels * 0.3 + rng.random(400) * 0.7, 0, 1), 2)
+        curve = threshold_curve(scores, labels)
+        self.assertEqual(len(curve), len(np.unique(scores)) + 1)
+        for row in curve.itertuples():
+            predictions = scores > row.threshold
+            np.testing.assert_allclose([row.precision, row.recall, row.f1],
+                                       sklearn_scores(labels, predictions, 'binary'))
+        brute = max(f1_score(labels, scores > threshold, zero_division=0)
+                    for threshold in np.linspace(0, 1, 1001))
+        self.assertAlmostEqual(curve.f1.max(), brute)
+
+        scores = rng.random(1000000)
+        labels = rng.random(1000000) < scores
+        curve = threshold_curve(scores, labels)
+        self.assertEqual(len(curve), len(np.unique(scores)) + 1)
+
+    def test_tag_thresholds(self):
+        scores = np.round(self.scores, 2)
+        valid = np.ones((128, ), dtype=bool)
+        valid[100:] = False
+        thresholds, f1 = tag_thresholds(scores, self.labels, valid)
+        self.assertTrue(np.isinf(thresholds[100:]).all())
+        for label in range(100):
+            curve = threshold_curve(scores[:, label], self.labels[:, label])
+            self.assertAlmostEqual(f1[label], curve.f1.max())
+            self.assertAlmostEqual(f1_score(self.labels[:, label], scores[:, label] > thresholds[label],
+                                            zero_division=0), curve.f1.max())
+
+    def test_compute_metrics(self):
+        rng = np.random.default_rng(4)
+        for classes, average in [(2, 'binary'), (4, 'macro')]:
+            labels = rng.integers(0, classes, 300)
+            logits = rng.normal(size=(300, classes)) + np.eye(classes)[labels]
+            metrics = compute_metrics((logits, labels))
+            np.testing.assert_allclose([metrics['precision'], metrics['recall'], metrics['f1']],
+                                       sklearn_scores(labels, logits.argmax(axis=1), average))
+        logits = np.log(self.scores + 1e-6) - np.log(1 - self.scores + 1e-6)
+        metrics = compute_metrics((logits, self.labels))
+        np.testing.assert_allclose([metrics['precision'], metrics['recall'], metrics['f1']],
+                                   sklearn_scores(self.labels, logits > 0, 'weighted'))
+
+    def test_slice_table(self):
+        rng = np.random.default_rng(3)
+        words = np.array(["<b>Taunt</b>", "Battlecry: Deal 2 damage.", "Draw a card.", "x" * 300, "Rush. Taunt"])
+        data = pd.DataFrame({'id': [f"{['CS2', 'EX1', 'BT'][i % 3]}_{i}" for i in range(500)],
+                             'text': words[rng.integers(0, len(words), 500)]})
+        slices = card_slices(data, self.labels)
+        table = slice_table(self.labels, self.scores, slices)
+        self.assertEqual(set(table.slice), {'length', 'tag', 'set', 'keyword'})
+        self.assertEqual(table[table.slice == 'set'].set_index('value').cards.to_dict(), {'BT': 166, 'CS2': 167, 'EX1': 167})
+        self.assertEqual(table[table.slice == 'length'].cards.sum(), 500)
+        # Column 0 is NONE, it has no tag slice
+        self.assertEqual(table[table.slice == 'tag'].cards.sum(), self.labels[:, 1:].sum())
+        for row in table.itertuples():
+            rows, values = slices[row.slice]
+            members = np.unique(rows[values == row.value])
+            self.assertEqual(len(members), row.cards)
+            expected = ConfusionCounts.from_dense(self.labels[members], self.scores[members]).score('weighted')
+            np.testing.assert_allclose([row.precision, row.recall, row.f1], expected)
+        keyword = table[table.slice == 'keyword'].set_index('value').cards
+        self.assertEqual(keyword['Taunt'], data.text.str.contains('Taunt').sum())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+import unittest
+import os
+import re
+import tempfile
+import numpy as np
+import pandas as pd
+from unittest import mock
+from loader.tags import Tags, TagRegistry, labels, get_tag_name, get_tag_id
+
+cards = [
+    "Fireball^CS2_029^Deal $6 damage.^1:0~^",
+    "Wisp^CS2_231^^^",
+    "Flame Imp^EX1_319^<b>Battlecry:</b> Deal 3 damage to your hero.^^",
+    "Sunfury Protector^EX1_058^[x]<b>Battlecry:</b> Give adjacent\\nminions <b>Taunt</b>.^^MINION",
+    "Shadow Word: Pain^CS2_234^Destroy a minion with 3 or less Attack.^1:0~8:3~^",
+    "Arcane Missiles^EX1_277^Deal $3 damage randomly split among all enemies.^^",
+    "Power Word: Shield^CS2_004^Give a minion +2 Health.\\nDraw a card.^1:0~11:0~^SPELL",
+    "Doomsayer^NEW1_021^At the start of your turn, destroy ALL minions.^^",
+    "Spell Echo^X_1^Costs (@) more. <i>\"Quoted\" flavour</i>@$^3:1~9:0~22:0~75:0~^",
+    "Unclosed^X_2^Deal 1 <b damage^17:0~^",
+    # Markup overlapping the layout marker or other markup, and whitespace around the line
+    "Overlap^X_3^[<b>x]Deal 2 damage.^1:0~^",
+    "Nested^X_4^<b><<b>b>Taunt</b>^^",
+    "  Padded^X_5^Draw a card.^2:0~^SPELL \t ",
+]
+filename = '2022-11-16-16-28-26 Tags.csv'
+
+
+def legacy_requirements(raw):
+    dims = np.zeros((Tags.label_dim, ))
+    for split in raw.split("~"):
+        if len(split) == 0:
+            continue
+        dims[int(split.split(":")[0])] = 1
+    return dims
+
+
+def legacy_load(path):
+    """
+    Reference copy of the original line-by-line Tags.load
+    """
+    ids = []
+    descriptions = []
+    requirements = []
+    has_requirements = []
+    with open(path) as f:
+        for line in f.readlines():
+            line = line.strip()
+            indices = line.split("^")
+            card_description = indices[2]
+            for identifier in re.findall("<[^>]*>", card_description):
+                card_description = card_description.replace(identifier, "")
+            card_description = card_description.replace("[x]", "").replace("@", "0").replace("$", "")
+            ids.append(indices[1])
+            descriptions.append(card_description)
+            requirements.append(legacy_requirements(indices[3]))
+            has_requirements.append(len(indices[3]) > 0)
+    return pd.DataFrame(list(zip(ids, descriptions, requirements, has_requirements)),
+                        columns=['id', 'text', 'requirements', 'has_requirement'])
+
+
+class TagsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data_path = self.directory.name
+        with open(os.path.join(self.data_path, filename), "w") as f:
+            f.write("\n".join(cards * 3) + "\n")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_load_parity(self):
+        expected = legacy_load(os.path.join(self.data_path, filename))
+        tags = Tags(self.data_path)
+        tags.chunk_size = 4
+        tags.load()
+        self.assertEqual(len(tags.df), len(expected))
+        self.assertEqual(tags.df['id'].tolist(), expected['id'].tolist())
+        self.assertEqual(tags.df['text'].tolist(), expected['text'].tolist())
+        self.assertEqual(tags.df['has_requirement'].tolist(), expected['has_requirement'].tolist())
+        np.testing.assert_array_equal(tags.dense_labels(), np.stack(expected['requirements']))
+
+    def test_label_matrix(self):
+        tags = Tags(self.data_path)
+        tags.load()
+        self.assertEqual(tags.label_matrix.dtype, np.uint8)
+        self.assertEqual(tags.label_matrix.shape, (len(cards) * 3, Tags.label_dim // 8))
+        self.assertNotIn('requirements', tags.df.columns)
+        dense = tags.dense_labels(np.array([0, 8]))
+        self.assertEqual(dense.dtype, np.float32)
+        self.assertEqual(np.flatnonzero(dense[0]).tolist(), [1])
+        self.assertEqual(np.flatnonzero(dense[1]).tolist(), [3, 9, 22, 75])
+
+    def test_cache(self):
+        expected = Tags(self.data_path, use_cache=False)
+        expected.load()
+        Tags(self.data_path).load()
+        with mock.patch.object(Tags, 'parse', side_effect=AssertionError("cache was not used")):
+            tags = Tags(self.data_path)
+            tags.load()
+        pd.testing.assert_frame_equal(tags.df, expected.df)
+        np.testing.assert_array_equal(tags.label_matrix, expected.label_matrix)
+        self.assertIsInstance(tags.label_matrix, np.memmap)
+
+        with open(os.path.join(self.data_path, filename), "a") as f:
+            f.write("Abusive Sergeant^CS2_188^<b>Battlecry:</b> Give a minion +2 Attack this turn.^1:0~22:0~^\n")
+        tags = Tags(self.data_path)
+        tags.load()
+        self.assertEqual(len(tags.df), len(expected.df) + 1)
+        self.assertEqual(len(os.listdir(os.path.join(self.data_path, Tags.cache_dirname))), 1)
+
+    def test_multiple_dumps(self):
+        with open(os.path.join(self.data_path, '2022-12-01-09-00-00 Tags.csv'), "w") as f:
+            f.write("Fireball^CS2_029^Deal $7 damage.^1:0~^\n")
+            f.write("New Card^NEW_001^Draw a card.^^\n")
+        with open(os.path.join(self.data_path, 'notes.csv'), "w") as f:
+            f.write("ignored")
+        for workers in [1, 2]:
+            tags = Tags(self.data_path, workers=workers)
+            tags.load()
+            self.assertEqual(len(tags.parse_times), 2)
+            self.assertEqual(len(tags.df), len(tags.label_matrix))
+            self.assertEqual(tags.df['id'].tolist()[-2:], ['CS2_029', 'NEW_001'])
+            self.assertNotIn('CS2_029', tags.df['id'].tolist()[:-2])
+            self.assertEqual(tags.df['text'].tolist()[-2], 'Deal 7 damage.')
+            self.assertEqual(len(tags.df), len(cards) * 3 - 3 + 2)
+
+        tags = Tags(os.path.join(self.data_path, '2022-11-*'))
+        tags.load()
+        self.assertEqual(len(tags.df), len(cards) * 3)
+
+    def test_registry(self):
+        for name, id in labels.items():
+            self.assertEqual(get_tag_name(id), name)
+            self.assertEqual(get_tag_id(name), id)
+        self.assertEqual(get_tag_name(100), "INVALID")
+        self.assertEqual(get_tag_name(500), "INVALID")
+        self.assertEqual(get_tag_id("REQ_UNKNOWN"), -1)
+
+        registry = TagRegistry(labels)
+        # INVALID and NONE are not tags
+        self.assertEqual(registry.valid.sum(), len(labels) - 2)
+        self.assertFalse(registry.valid[get_tag_id("NONE")])
+        scores = np.random.default_rng(0).random((5, Tags.label_dim))
+        ids, ranked = registry.top_k(scores, k=3)
+        self.assertEqual(ids.shape, (5, 3))
+        for row in range(5):
+            expected = sorted(registry.valid_ids, key=lambda id: -scores[row, id])[:3]
+            self.assertEqual(ids[row].tolist(), expected)
+            np.testing.assert_array_equal(ranked[row], scores[row, expected])
+        per_tag = registry.decode(scores[0], threshold=np.full((Tags.label_dim, ), 0.5))
+        decoded = registry.decode(scores[0], threshold=0.5)
+        self.assertEqual(per_tag, decoded)
+        self.assertEqual(len(decoded), 1)
+        self.assertEqual([name for name, _ in decoded[0]],
+                         [get_tag_name(id) for id in sorted(registry.valid_ids, key=lambda id: -scores[0, id])
+                          if scores[0, id] > 0.5])
+
+    def test_diff(self):
+        tags = Tags(self.data_path)
+        tags.load()
+        delta = tags.diff()
+        self.assertEqual(len(delta.added), len(tags.df))
+        tags.commit()
+        self.assertEqual(len(tags.diff()), 0)
+
+        with open(os.path.join(self.data_path, filename), "w") as f:
+            lines = [card for card in cards if not card.startswith("Wisp")]
+            lines = [card.replace("Deal $6", "Deal $7") for card in lines]
+            lines = [card.replace("1:0~8:3~", "1:0~") for card in lines]
+            f.write("\n".join(lines + ["New Card^NEW_001^Draw a card.^^"]) + "\n")
+        tags = Tags(self.data_path)
+        tags.load()
+        delta = tags.diff()
+        self.assertEqual(tags.df['id'][delta.added].tolist(), ['NEW_001'])
+        self.assertEqual(tags.df['id'][delta.changed].tolist(), ['CS2_029', 'CS2_234'])
+        self.assertEqual(delta.removed.tolist(), ['CS2_231'])
+        self.assertEqual(tags.df['id'][delta.rows()].tolist(), ['CS2_029', 'CS2_234', 'NEW_001'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import tempfile
+from unittest import mock
+from loader.tokens import tokenize_texts
+from model import tokenization
+from model.tokenization import load_tokenizer, compare_tokenizers
+from util.benchmark import word_tokenizer, card_texts
+from transformers import BertTokenizer, BertTokenizerFast
+
+
+class TokenizationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        word_tokenizer(self.directory.name).save_pretrained(self.directory.name)
+        self.settings = dict(add_special_tokens=True, max_length=512, truncation=True)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_load_tokenizer(self):
+        tokenization.verified.clear()
+        tokenizer = load_tokenizer(self.directory.name, BertTokenizer)
+        self.assertIsInstance(tokenizer, BertTokenizerFast)
+        slow = BertTokenizer.from_pretrained(self.directory.name)
+        self.assertFalse(slow.is_fast)
+        self.assertEqual(compare_tokenizers(tokenizer, slow, card_texts(500), **self.settings), [])
+
+        # The comparison runs once per checkpoint, later loads reuse it
+        with mock.patch.object(tokenization, 'compare_tokenizers', return_value=[3]) as compare:
+            self.assertTrue(load_tokenizer(self.directory.name, BertTokenizer).is_fast)
+            compare.assert_not_called()
+            tokenization.verified.clear()
+            self.assertIsInstance(load_tokenizer(self.directory.name, BertTokenizer), BertTokenizer)
+            self.assertIsInstance(load_tokenizer(self.directory.name, BertTokenizer), BertTokenizer)
+            self.assertEqual(compare.call_count, 1)
+        tokenization.verified.clear()
+        with mock.patch.object(tokenization.AutoTokenizer, 'from_pretrained', side_effect=ValueError("no converter")):
+            self.assertIsInstance(load_tokenizer(self.directory.name, BertTokenizer), BertTokenizer)
+
+    def test_tokenize_texts(self):
+        fast = load_tokenizer(self.directory.name, BertTokenizer, verify=False)
+        slow = BertTokenizer.from_pretrained(self.directory.name)
+        texts = card_texts(100000)
+
+        encoded = tokenize_texts(fast, texts, self.settings)
+        self.assertEqual(len(encoded), len(texts))
+        # The slow paths run on a tenth of the texts to keep the suite short, util/benchmark.py times them
+        subset = texts[:10000]
+        for workers in [1, 2]:
+            self.assertEqual(tokenize_texts(slow, subset, self.settings, workers=workers), encoded[:10000])
+
+
+if __name__ == '__main__':
+    unittest.main()
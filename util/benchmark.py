@@ -0,0 +1,105 @@
+import os
+import time
+import logging
+import tempfile
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from transformers import BertConfig, BertForSequenceClassification, BertTokenizer
+from loader.tokens import tokenize_texts
+from model.batching import LengthBucketSampler, PaddingCollator
+from model.tokenization import load_tokenizer
+
+logging.basicConfig(format='%(asctime)s - %(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s',
+                    level=logging.INFO)
+
+
+def synthetic_examples(count, seed=0):
+    # Card texts are short with a long tail, a few reach the 512 token limit
+    rng = np.random.default_rng(seed)
+    lengths = np.clip(rng.lognormal(3.8, 0.6, count).astype(int), 4, 512)
+    return [{'input_ids': rng.integers(1, 1000, length).tolist(), 'attention_mask': [1] * length,
+             'label': int(rng.integers(0, 2))} for length in lengths]
+
+
+def word_tokenizer(folder):
+    """
+    Slow BERT tokenizer over a small card vocabulary written to folder
+    """
+    words = ["deal", "damage", "draw", "a", "card", "summon", "minion", "gain", "armor", "taunt"] + \
+            [str(number) for number in range(10)]
+    path = os.path.join(folder, "vocab.txt")
+    with open(path, "w") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + words) + "\n")
+    return BertTokenizer(path)
+
+
+def card_texts(count, seed=0):
+    rng = np.random.default_rng(seed)
+    words = ["Deal", "damage", "Draw", "a", "card", "Summon", "minion", "Gain", "Armor", "Taunt"]
+    return [" ".join(rng.choice(words, rng.integers(2, 30)).tolist()) + f" {index}" for index in range(count)]
+
+
+def throughput(model, loader, tokens, width=None):
+    """
+    :param width: pad every batch to this many tokens, the former fixed length padding
+    :return: tokens per second of a forward pass over the loader
+    """
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for data in loader:
+            input_ids, attention_mask = data['input_ids'], data['attention_mask']
+            if width is not None:
+                padding = width - input_ids.shape[1]
+                input_ids = torch.nn.functional.pad(input_ids, (0, padding))
+                attention_mask = torch.nn.functional.pad(attention_mask, (0, padding))
+            model(input_ids, attention_mask=attention_mask)
+    return tokens / (time.perf_counter() - start)
+
+
+def padding_throughput(count=128, batch_size=8):
+    """
+    Compare a small BERT on batches padded to 512 tokens and on length-bucketed batches padded dynamically
+    """
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=1000, hidden_size=64, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=128, max_position_embeddings=512)
+    model = BertForSequenceClassification(config).eval()
+    examples = synthetic_examples(count)
+    tokens = sum(len(example['input_ids']) for example in examples)
+    collator = PaddingCollator()
+    fixed = DataLoader(examples, batch_size=batch_size, collate_fn=collator)
+    sampler = LengthBucketSampler([len(example['input_ids']) for example in examples], batch_size)
+    bucketed = DataLoader(examples, batch_sampler=sampler, collate_fn=collator)
+    baseline = throughput(model, fixed, tokens, width=512)
+    dynamic = throughput(model, bucketed, tokens)
+    logging.info(f"CPU tokens/sec: fixed 512 {baseline:.0f}, length buckets {dynamic:.0f} "
+                 f"({dynamic / baseline:.1f}x)")
+    return baseline, dynamic
+
+
+def tokenize_throughput(count=100000, subset=10000, workers=None):
+    """
+    Texts per second of tokenize_texts on card texts with the fast tokenizer, and with the slow one in this
+    process and in a process pool of workers on the first subset texts
+    """
+    texts = card_texts(count)
+    settings = dict(add_special_tokens=True, max_length=512, truncation=True)
+    timings = {}
+    with tempfile.TemporaryDirectory() as folder:
+        slow = word_tokenizer(folder)
+        slow.save_pretrained(folder)
+        fast = load_tokenizer(folder, BertTokenizer, verify=False)
+        for name, tokenizer, rows, pool in [('fast', fast, texts, None), ('slow', slow, texts[:subset], 1),
+                                            ('slow pool', slow, texts[:subset], workers)]:
+            start = time.perf_counter()
+            tokenize_texts(tokenizer, rows, settings, workers=pool)
+            timings[name] = len(rows) / (time.perf_counter() - start)
+    logging.info("Tokenizing card texts: " + ", ".join(f"{name} {speed:.0f} texts/s"
+                                                       for name, speed in timings.items()))
+    return timings
+
+
+if __name__ == "__main__":
+    padding_throughput()
+    tokenize_throughput()
@@ -0,0 +1,162 @@
+import os
+import logging
+import itertools
+import numpy as np
+import pandas as pd
+import torch
+from loader.artifacts import read_manifest
+from loader.tags import registry
+from util.metrics import ConfusionCounts
+from util.opt import tag_thresholds
+
+
+def member_scores(logits, labels):
+    """
+    Probabilities of stored logits, the positive class of two-class heads is kept as a single label
+    :return: (N, L) probabilities and (N, L) labels
+    """
+    logits = np.asarray(logits, dtype=np.float32)
+    labels = np.asarray(labels)
+    if labels.ndim == 1:
+        logits = logits[:, 1:2] - logits[:, :1]
+        labels = labels[:, None]
+    return 1 / (1 + np.exp(-logits)), labels
+
+
+class Ensemble:
+    """
+    Blend the stored logits of several models predicted on the same cards
+    Every member is a prediction folder written by BaseLoader.prob or prob_writers. Its rows are aligned
+    on the card ids of its manifest and read through memory maps. The blend is a convex combination of the
+    members' probabilities, with one weight per model or one per model and tag, learned on validation rows
+    by minimizing the binary cross entropy. Per-tag thresholds of the blend are tuned on the same rows.
+    """
+
+    def __init__(self, loader, folders, names=None):
+        """
+        :param loader: loader used to read the folders
+        :param folders: prediction folders, one per model
+        :param names: member names, the model names of the manifests by default
+        """
+        self.loader = loader
+        self.logits = []
+        self.seconds = []
+        self.names = []
+        ids = None
+        for position, folder in enumerate(folders):
+            logits, labels = loader.load_prob(folder)
+            manifest = {}
+            if os.path.isfile(os.path.join(folder, loader.manifest_filename)):
+                manifest = read_manifest(folder, loader.manifest_filename)
+            member_ids = np.load(os.path.join(folder, manifest['ids'])) if 'ids' in manifest else None
+            if position == 0:
+                ids = member_ids
+                self.labels = labels
+            elif ids is not None and member_ids is not None and not np.array_equal(member_ids, ids):
+                # Reordering reads the member into memory, folders predicted in the same order stay mapped
+                order = pd.Index(member_ids).get_indexer(ids)
+                if (order < 0).any():
+                    raise ValueError(f"{folder} misses {(order < 0).sum()} of the ensembled cards")
+                logits = logits[order]
+            elif len(logits) != len(self.labels):
+                raise ValueError(f"{folder} has {len(logits)} rows instead of {len(self.labels)}")
+            self.logits.append(logits)
+            self.seconds.append(manifest.get('seconds'))
+            self.names.append(names[position] if names is not None else manifest.get('model') or os.path.basename(folder))
+        self.ids = ids
+        self.weights = None
+        self.members = None
+        self.thresholds = None
+
+    def scores(self, members, index=None):
+        """
+        :return: (M, N, L) member probabilities and (N, L) labels of the selected rows
+        """
+        rows = slice(None) if index is None else index
+        scores = []
+        for member in members:
+            probs, labels = member_scores(self.logits[member][rows], self.labels[rows])
+            scores.append(probs)
+        return np.stack(scores), labels
+
+    def fit(self, index, members=None, per_tag=False, steps=200, learning_rate=0.05):
+        """
+        Learn blend weights and thresholds on validation rows
+        :param index: validation rows
+        :param members: positions of the blended models, all of them by default
+        :param per_tag: learn one weight per model and tag instead of one per model
+        :return: (M, ) or (M, L) blend weights
+        """
+        self.members = list(range(len(self.logits))) if members is None else list(members)
+        scores, labels = self.scores(self.members, index)
+        scores = torch.from_numpy(scores).clamp(1e-6, 1 - 1e-6)
+        targets = torch.from_numpy(labels.astype(np.float32))
+        parameters = torch.zeros((len(self.members), scores.shape[2] if per_tag else 1), requires_grad=True)
+        optimizer = torch.optim.Adam([parameters], lr=learning_rate)
+        for _ in range(steps if len(self.members) > 1 else 0):
+            optimizer.zero_grad()
+            blend = (torch.softmax(parameters, dim=0)[:, None, :] * scores).sum(dim=0)
+            loss = torch.nn.functional.binary_cross_entropy(blend, targets)
+            loss.backward()
+            optimizer.step()
+        self.weights = torch.softmax(parameters, dim=0).detach().numpy()
+        blend = self.blend_scores(scores.numpy())
+        valid = registry.valid if blend.shape[1] == registry.label_dim else None
+        self.thresholds, _ = tag_thresholds(blend, labels, valid)
+        logging.info(f"Blend of {[self.names[member] for member in self.members]} fitted on {len(labels)} rows")
+        return self.weights if per_tag else self.weights[:, 0]
+
+    def blend_scores(self, scores):
+        return (self.weights[:, None, :] * scores).sum(axis=0)
+
+    def blend(self, index=None):
+        """
+        :return: (N, L) blended probabilities of the selected rows
+        """
+        scores, _ = self.scores(self.members, index)
+        return self.blend_scores(scores)
+
+    def predict(self, index=None):
+        """
+        :return: (N, L) boolean predictions of the selected rows at the tuned thresholds
+        """
+        return self.blend(index) > self.thresholds
+
+    def evaluate(self, index=None):
+        """
+        :return: ConfusionCounts of the blend on the selected rows
+        """
+        labels = self.labels[slice(None) if index is None else index]
+        return ConfusionCounts.from_dense(labels.reshape(len(labels), -1), self.predict(index))
+
+    def cost(self, members=None):
+        members = self.members if members is None else members
+        seconds = [self.seconds[member] for member in members]
+        return None if any(second is None for second in seconds) else float(sum(seconds))
+
+    def compare(self, valid_index, test_index, candidates=None, per_tag=False, baseline=None):
+        """
+        Fit every candidate blend on the validation rows and score it on the test rows
+        :param candidates: tuples of member positions, every single model and pair plus the full blend by default
+        :param baseline: member name the others are compared to, e.g. the XLarge model
+        :return: DataFrame with one row per candidate: members, weights, precision, recall, f1 and inference cost
+        """
+        count = len(self.logits)
+        if candidates is None:
+            candidates = [(member, ) for member in range(count)] + list(itertools.combinations(range(count), 2))
+            if count > 2:
+                candidates.append(tuple(range(count)))
+        rows = []
+        for members in candidates:
+            weights = self.fit(valid_index, members, per_tag)
+            precision, recall, f1 = self.evaluate(test_index).score('weighted')
+            rows.append({'members': " + ".join(self.names[member] for member in members),
+                         'weights': np.round(np.float64(weights if not per_tag else weights.mean(axis=1)), 3).tolist(),
+                         'precision': precision, 'recall': recall, 'f1': f1, 'seconds': self.cost(members)})
+        table = pd.DataFrame(rows)
+        if baseline is not None:
+            reference = table[table.members == baseline].iloc[0]
+            table['f1_delta'] = table.f1 - reference.f1
+            if reference.seconds:
+                table['relative_cost'] = table.seconds / reference.seconds
+        return table.sort_values('f1', ascending=False, ignore_index=True)
@@ -0,0 +1,154 @@
+import numpy as np
+import pandas as pd
+
+
+def safe_divide(numerator, denominator):
+    # sklearn's zero_division="warn" scores undefined ratios as 0
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator != 0)
+
+
+class ConfusionCounts:
+    """
+    Per-label true positive, false positive and false negative counts
+    Every precision, recall and F1 average is derived from these counts, which are computed in a single
+    vectorized pass and can be summed across batches.
+    """
+    averages = ['micro', 'macro', 'weighted']
+
+    def __init__(self, tp, fp, fn, classes=None):
+        self.tp = np.asarray(tp, dtype=np.int64)
+        self.fp = np.asarray(fp, dtype=np.int64)
+        self.fn = np.asarray(fn, dtype=np.int64)
+        self.classes = np.arange(len(self.tp)) if classes is None else np.asarray(classes)
+
+    @classmethod
+    def from_dense(cls, labels, predictions, threshold=0.5):
+        """
+        Count a (N, L) multi-label problem, or a (N, ) problem over class ids, without modifying the inputs
+        :param labels: (N, L) 0/1 matrix or (N, ) class ids
+        :param predictions: scores of the same shape, binarized at threshold
+        :param threshold: scores at or above it count as positive
+        """
+        labels, predictions, classes = cls.binarize(labels, predictions, threshold)
+        tp = np.count_nonzero(labels & predictions, axis=0)
+        predicted = np.count_nonzero(predictions, axis=0)
+        support = np.count_nonzero(labels, axis=0)
+        return cls(tp, predicted - tp, support - tp, classes)
+
+    @staticmethod
+    def binarize(labels, predictions, threshold=0.5):
+        """
+        :return: (N, L) boolean labels and predictions, and the class of every column (None for multi-label inputs)
+        """
+        labels = np.asarray(labels)
+        predictions = np.asarray(predictions) >= threshold
+        if labels.ndim == 1:
+            # Class ids are scored one-vs-rest over the classes seen in either array, like sklearn
+            predictions = predictions.astype(labels.dtype)
+            classes = np.union1d(labels, predictions)
+            return labels[:, None] == classes, predictions[:, None] == classes, classes
+        return labels.astype(bool), predictions, None
+
+    @classmethod
+    def from_packed(cls, labels, predictions, label_dim=128):
+        """
+        Count bit-packed label and prediction matrices with bitwise operations
+        :param labels: (N, label_dim / 8) uint8 matrix as produced by pack_requirements
+        :param predictions: packed predictions of the same shape
+        """
+        labels = np.asarray(labels, dtype=np.uint8)
+        predictions = np.asarray(predictions, dtype=np.uint8)
+
+        def count(bits):
+            return np.unpackbits(bits, axis=1, count=label_dim, bitorder='little').sum(axis=0, dtype=np.int64)
+
+        return cls(count(labels & predictions), count(~labels & predictions), count(labels & ~predictions))
+
+    def __add__(self, other):
+        return ConfusionCounts(self.tp + other.tp, self.fp + other.fp, self.fn + other.fn, self.classes)
+
+    @property
+    def support(self):
+        return self.tp + self.fn
+
+    def per_label(self):
+        """
+        :return: precision, recall and F1 arrays with one entry per label
+        """
+        precision = safe_divide(self.tp, self.tp + self.fp)
+        recall = safe_divide(self.tp, self.tp + self.fn)
+        f1 = safe_divide(2 * self.tp, 2 * self.tp + self.fp + self.fn)
+        return precision, recall, f1
+
+    def score(self, average='weighted'):
+        """
+        :param average: 'micro', 'macro' or 'weighted', as in sklearn
+        :return: precision, recall, F1
+        """
+        if average == 'micro':
+            tp, fp, fn = self.tp.sum(), self.fp.sum(), self.fn.sum()
+            return (float(safe_divide(tp, tp + fp)), float(safe_divide(tp, tp + fn)),
+                    float(safe_divide(2 * tp, 2 * tp + fp + fn)))
+        scores = self.per_label()
+        if average == 'macro':
+            return tuple(float(score.mean()) if len(score) else 0.0 for score in scores)
+        if average == 'weighted':
+            support = self.support
+            if support.sum() == 0:
+                return 0.0, 0.0, 0.0
+            return tuple(float(np.average(score, weights=support)) for score in scores)
+        raise ValueError(f"Unknown average {average}, expected one of {self.averages}")
+
+    def report(self):
+        """
+        :return: dict with precision/recall/f1 for every average
+        """
+        report = {}
+        for average in self.averages:
+            precision, recall, f1 = self.score(average)
+            report.update({f'{average}_precision': precision, f'{average}_recall': recall, f'{average}_f1': f1})
+        return report
+
+    def table(self):
+        """
+        :return: DataFrame with the counts and scores of every label
+        """
+        precision, recall, f1 = self.per_label()
+        return pd.DataFrame({'label': self.classes, 'tp': self.tp, 'fp': self.fp, 'fn': self.fn,
+                             'support': self.support, 'precision': precision, 'recall': recall, 'f1': f1})
+
+
+def compute_metrics(eval_pred, threshold=0.0):
+    """
+    Trainer compute_metrics hook, computed locally with NumPy
+    (N, C) logits with (N, ) class labels are scored on the arg max like the "precision", "recall" and "f1"
+    metrics of the datasets hub: for the positive class 1 when the labels are binary, macro averaged otherwise.
+    (N, L) logits with (N, L) multi-label targets keep the labels whose logit is above threshold and are
+    weighted averaged like BaseLoader.eval.
+    :param eval_pred: (logits, labels) pair or transformers.EvalPrediction
+    :param threshold: logit threshold of the multi-label case, 0 is a probability of 0.5
+    :return: dict with precision, recall and f1
+    """
+    logits, labels = eval_pred
+    logits = np.asarray(logits)
+    labels = np.asarray(labels)
+    if labels.ndim == 1:
+        predictions = logits.argmax(axis=-1) if logits.ndim > 1 else logits
+        if len(labels) == 0 or min(labels.min(), predictions.min()) >= 0 and max(labels.max(), predictions.max()) <= 1:
+            classes = np.array([1])
+            average = 'micro'
+        else:
+            classes = np.union1d(labels, predictions)
+            average = 'macro'
+        truths = labels[:, None] == classes
+        positives = predictions[:, None] == classes
+    else:
+        truths = labels.astype(bool)
+        positives = logits > threshold
+        average = 'weighted'
+    tp = np.count_nonzero(truths & positives, axis=0)
+    counts = ConfusionCounts(tp, np.count_nonzero(positives, axis=0) - tp, np.count_nonzero(truths, axis=0) - tp)
+    precision, recall, f1 = counts.score(average)
+    return {"precision": precision, "recall": recall, "f1": f1}
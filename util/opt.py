@@ -1,44 +1,146 @@
 import numpy as np
+import pandas as pd
 import os
 import logging
 import warnings
-import GPyOpt
 from sklearn.metrics import precision_score, recall_score, f1_score
+from loader.tags import registry
+
+
+def threshold_curve(scores, labels):
+    """
+    Exact precision/recall/F1 of the rule "score > threshold" at every distinct cut of the scores
+    The scores are sorted once and the confusion counts of every cut come from cumulative sums,
+    so the whole curve costs O(N log N).
+    :param scores: (N, ) scores of the positive class
+    :param labels: (N, ) 0/1 labels
+    :return: DataFrame with threshold, precision, recall and f1 columns, by decreasing threshold
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    labels = np.asarray(labels) > 0
+    if len(scores) == 0:
+        return pd.DataFrame({'threshold': [], 'precision': [], 'recall': [], 'f1': []})
+    order = np.argsort(-scores, kind='stable')
+    scores = scores[order]
+    labels = labels[order]
+    # Every cut includes whole groups of tied scores, it ends on the last row of a group
+    ends = np.flatnonzero(np.diff(scores) != 0)
+    ends = np.append(ends, len(scores) - 1)
+    tp = np.concatenate([[0], np.cumsum(labels)[ends]])
+    predicted = np.concatenate([[0], ends + 1])
+    positives = labels.sum()
+    # A cut's threshold is the next lower score, the empty cut sits on the highest score
+    thresholds = np.concatenate([scores[:1], scores[ends[:-1] + 1], [np.nextafter(scores[-1], -np.inf)]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(predicted > 0, tp / predicted, 0.0)
+        recall = np.where(positives > 0, tp / max(positives, 1), 0.0)
+        f1 = np.where(predicted + positives > 0, 2 * tp / (predicted + positives), 0.0)
+    return pd.DataFrame({'threshold': thresholds, 'precision': precision, 'recall': recall, 'f1': f1})
+
+
+def tag_thresholds(scores, labels, valid=None):
+    """
+    Independent F1-optimal threshold of every label, searched for all labels at once
+    Each column is sorted once and its F1 at every cut comes from a cumulative sum along the rows.
+    :param scores: (N, L) probabilities
+    :param labels: (N, L) 0/1 labels
+    :param valid: optional (L, ) mask, labels outside of it get an infinite threshold
+    :return: (L, ) thresholds for the rule "score > threshold" and (L, ) F1 reached at them
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    n, label_dim = scores.shape
+    order = np.argsort(-scores, axis=0, kind='stable')
+    scores = np.take_along_axis(scores, order, axis=0)
+    labels = np.take_along_axis(np.asarray(labels) > 0, order, axis=0)
+    tp = np.cumsum(labels, axis=0)
+    positives = labels.sum(axis=0)
+    f1 = 2 * tp / (np.arange(1, n + 1)[:, None] + positives)
+    # Only cuts after the last row of a group of tied scores are reachable
+    f1[:-1][scores[:-1] == scores[1:]] = -1
+    best = f1.argmax(axis=0)
+    columns = np.arange(label_dim)
+    best_f1 = f1[best, columns]
+    lower = np.vstack([scores[1:], np.nextafter(scores[-1:], -np.inf)])
+    thresholds = lower[best, columns]
+    # Predicting nothing is best when no cut scores above 0
+    empty = best_f1 <= 0
+    thresholds[empty] = scores[0, empty]
+    best_f1[empty] = 0.0
+    if valid is not None:
+        thresholds[~np.asarray(valid)] = np.inf
+    return thresholds, best_f1
 
 
 class ThresholdOptimizer:
-    def __init__(self, loader):
+    """
+    Tune the decision threshold of the positive class
+    method="exact" sweeps every distinct cut of the scores, method="bayesian" runs GPyOpt.
+    """
+
+    def __init__(self, loader, method="exact"):
         warnings.filterwarnings('ignore')
         self.data_loader = loader
-        self.prob_path = os.path.join(self.data_loader.storage_folder, self.data_loader.prob_dir, self.data_loader.prob_filename)
-        self.label_path = os.path.join(self.data_loader.storage_folder, self.data_loader.prob_dir, self.data_loader.label_filename)
-        self.probs = np.loadtxt(self.prob_path)
-        self.labels = np.loadtxt(self.label_path)
+        self.method = method
+        self.probs, self.labels = self.data_loader.load_prob()
         # format digits to probabilities
-        self.probs = 1 / (1 + np.exp(-self.probs))
-        self.bounds = [{'name': 'threshold', 'type': 'continuous', 'domain': (0, 1)}]
-        self.optimizer = GPyOpt.methods.BayesianOptimization(f=self.optimizer_step,
-                                                             domain=self.bounds,
-                                                             model_type='GP',
-                                                             acquisition_type='EI',
-                                                             maximize=True)
+        self.probs = 1 / (1 + np.exp(-np.asarray(self.probs, dtype=np.float64)))
+        self.curve = None
+        if self.method == "bayesian":
+            import GPyOpt
+            self.bounds = [{'name': 'threshold', 'type': 'continuous', 'domain': (0, 1)}]
+            self.optimizer = GPyOpt.methods.BayesianOptimization(f=self.optimizer_step,
+                                                                 domain=self.bounds,
+                                                                 model_type='GP',
+                                                                 acquisition_type='EI',
+                                                                 maximize=True)
 
     def run(self, iteration=2000, time=6000, step=1e-5):
+        """
+        :return: the optimal threshold
+        """
+        if self.method == "exact":
+            self.curve = threshold_curve(self.probs[:, 1], self.labels)
+            best = self.curve.iloc[int(self.curve.f1.to_numpy().argmax())]
+            self.optimal = best.threshold
+            self.curve.to_csv(os.path.join(self.data_loader.prob_folder, "threshold_curve.csv"), index=False)
+            logging.info(f"Obtained optimal threshold {self.optimal}: Precision {best.precision}, Recall {best.recall}, F1-Score {best.f1}.")
+            return self.optimal
         self.optimizer.run_optimization(iteration, time, step)
-        self.optimizer.plot_convergence(filename=os.path.join(self.data_loader.storage_folder, self.data_loader.prob_dir, "convergence.png"))
+        self.optimizer.plot_convergence(filename=os.path.join(self.data_loader.prob_folder, "convergence.png"))
         self.optimal = self.optimizer.x_opt
         logging.info(f"Obtained optimal threshold {self.optimal}: F1-Score {self.optimizer_step(np.array([self.optimal]))}.")
-
+        return self.optimal
 
     def optimizer_step(self, params):
-        threshold = params[0]
-        prediction = np.zeros(self.labels.shape)
-        for index in range(self.labels.shape[0]):
-            if self.probs[index, 1] > threshold:
-                prediction[index] = 1
+        threshold = np.ravel(params)[0]
+        prediction = (self.probs[:, 1] > threshold).astype(np.float64)
         precision = precision_score(self.labels, prediction)
         recall = recall_score(self.labels, prediction)
         f1 = f1_score(self.labels, prediction)
         logging.info(f"Optimizer step: Threshold {threshold}, Precision {precision}, Recall {recall}, F1-Score {f1}")
         return f1
-        
+
+
+class TagThresholdOptimizer:
+    """
+    Tune one threshold per valid tag of the multi-label head and store the vector next to the checkpoint
+    """
+
+    def __init__(self, loader):
+        self.data_loader = loader
+        self.threshold_path = os.path.join(self.data_loader.storage_folder, "output", self.data_loader.threshold_filename)
+        probs, self.labels = self.data_loader.load_prob()
+        # format digits to probabilities
+        self.probs = 1 / (1 + np.exp(-np.asarray(probs, dtype=np.float64)))
+
+    def run(self):
+        """
+        :return: (label_dim, ) threshold vector
+        """
+        valid = registry.valid[:self.probs.shape[1]]
+        self.thresholds, self.f1 = tag_thresholds(self.probs, self.labels, valid)
+        os.makedirs(os.path.dirname(self.threshold_path), exist_ok=True)
+        np.save(self.threshold_path, self.thresholds)
+        logging.info(f"Obtained {valid.sum()} tag thresholds, mean F1-Score {self.f1[valid].mean()}, "
+                     f"saved to {self.threshold_path}.")
+        return self.thresholds
@@ -0,0 +1,72 @@
+import os
+import time
+import logging
+import torch
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+worker_state = {}
+
+
+def init_worker(loader, train_fn, threads):
+    # Every worker gets its own share of the cores instead of one intra-op pool per core
+    torch.set_num_threads(threads)
+    worker_state['loader'] = loader
+    worker_state['train_fn'] = train_fn
+
+
+def run_fold(train_index, valid_index, test_index, outer, inner):
+    start = time.perf_counter()
+    scores = worker_state['train_fn'](worker_state['loader'], train_index, valid_index, test_index)
+    return dict(outer=outer, inner=inner, seconds=time.perf_counter() - start, **scores)
+
+
+class FoldRunner:
+    """
+    Train the folds of CustomLoader.nested_fold concurrently in a process pool
+    train_fn(loader, train_index, valid_index, test_index) must be a picklable, module level function
+    returning a dict of scores. Finished folds are appended to a results table as they complete and
+    are skipped when the runner is started again. The table is named after k and seed, runners splitting
+    the data differently never resume from each other.
+    """
+    results_filename = "folds-k{k}-seed{seed}.csv"
+    columns = ['outer', 'inner', 'seconds']
+
+    def __init__(self, loader, train_fn, k=5, workers=None, threads_per_worker=None, seed=42):
+        self.loader = loader
+        self.train_fn = train_fn
+        self.k = k
+        self.seed = seed
+        self.workers = workers or os.cpu_count()
+        self.threads_per_worker = threads_per_worker or max(1, os.cpu_count() // self.workers)
+        self.results_path = os.path.join(self.loader.storage_folder, self.results_filename.format(k=k, seed=seed))
+
+    def finished(self):
+        if not os.path.isfile(self.results_path):
+            return set()
+        results = pd.read_csv(self.results_path, usecols=['outer', 'inner'])
+        return set(zip(results.outer, results.inner))
+
+    def record(self, scores):
+        pd.DataFrame([scores]).to_csv(self.results_path, mode='a', index=False,
+                                      header=not os.path.isfile(self.results_path))
+
+    def run(self):
+        """
+        :return: DataFrame with one row of scores per (outer, inner) fold
+        """
+        done = self.finished()
+        folds = [fold for fold in self.loader.nested_fold(self.k, self.seed) if (fold[3], fold[4]) not in done]
+        logging.info(f"Running {len(folds)} folds, {len(done)} already finished, "
+                     f"{self.workers} workers x {self.threads_per_worker} threads")
+        if len(folds) > 0:
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(folds)), initializer=init_worker,
+                                     initargs=(self.loader, self.train_fn, self.threads_per_worker)) as executor:
+                futures = [executor.submit(run_fold, *fold) for fold in folds]
+                for future in as_completed(futures):
+                    scores = future.result()
+                    self.record(scores)
+                    logging.info(f"Fold {scores['outer']}-{scores['inner']} finished in {scores['seconds']:.1f}s")
+        if not os.path.isfile(self.results_path):
+            return pd.DataFrame(columns=self.columns)
+        return pd.read_csv(self.results_path).sort_values(['outer', 'inner']).reset_index(drop=True)
@@ -0,0 +1,145 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+from loader.artifacts import read_manifest
+from loader.tags import registry, unpack_requirements
+from util.metrics import ConfusionCounts
+
+length_bins = [128, 256, 512]
+length_names = np.array(['0-127', '128-255', '256-511', '512+'], dtype=object)
+keywords = ['Battlecry', 'Deathrattle', 'Taunt', 'Divine Shield', 'Charge', 'Rush', 'Windfury', 'Stealth',
+            'Lifesteal', 'Poisonous', 'Spell Damage', 'Discover', 'Secret', 'Combo', 'Overload', 'Freeze',
+            'Silence', 'Reborn', 'Outcast', 'Echo', 'Magnetic', 'Inspire', 'Choose One', 'Adapt']
+
+
+def length_slices(text, bins=None, names=None):
+    """
+    One slice per text length bucket
+    :return: member rows and slice value of every membership
+    """
+    bins = length_bins if bins is None else bins
+    names = length_names if names is None else np.asarray(names, dtype=object)
+    lengths = pd.Series(text).str.len().to_numpy()
+    return np.arange(len(lengths)), names[np.digitize(lengths, bins)]
+
+
+def tag_slices(label_matrix, label_dim=128):
+    """
+    One slice per requirement tag, a card belongs to the slice of every tag it carries
+    :param label_matrix: packed (N, label_dim / 8) uint8 matrix or dense (N, label_dim) 0/1 matrix
+    """
+    label_matrix = np.asarray(label_matrix)
+    if label_matrix.dtype == np.uint8 and label_matrix.shape[1] * 8 == label_dim:
+        label_matrix = unpack_requirements(label_matrix, label_dim, bool)
+    rows, ids = np.nonzero(label_matrix)
+    keep = ids != registry.id("NONE")
+    rows, ids = rows[keep], ids[keep]
+    # Ids missing from the registry keep their number so that they do not merge into one slice
+    names = np.where(registry.valid, registry.id_to_name, np.arange(label_dim).astype(str).astype(object))
+    return rows, names[ids]
+
+
+def set_slices(ids):
+    """
+    One slice per card set, the prefix of the card id before its first underscore
+    """
+    return np.arange(len(ids)), pd.Series(ids).str.split('_', n=1).str[0].to_numpy(dtype=object)
+
+
+def keyword_slices(text, words=None):
+    """
+    One slice per keyword found in the card text, a card belongs to the slice of every keyword it mentions
+    """
+    words = keywords if words is None else words
+    text = pd.Series(text).reset_index(drop=True)
+    found = np.column_stack([text.str.contains(rf"\b{re.escape(word)}\b", case=False, regex=True).to_numpy()
+                             for word in words])
+    rows, columns = np.nonzero(found)
+    return rows, np.asarray(words, dtype=object)[columns]
+
+
+def card_slices(data, label_matrix):
+    """
+    :param data: frame with the id and text of every card
+    :param label_matrix: packed or dense requirement matrix of the same cards
+    :return: dict from slice name to (rows, values)
+    """
+    return {
+        'length': length_slices(data['text']),
+        'tag': tag_slices(label_matrix),
+        'set': set_slices(data['id']),
+        'keyword': keyword_slices(data['text']),
+    }
+
+
+def slice_counts(labels, predictions, rows, values, threshold=0.5):
+    """
+    Confusion counts of every slice value in one grouped pass over the memberships
+    :param labels: (N, L) 0/1 matrix or (N, ) class ids
+    :param predictions: scores of the same shape, binarized at threshold as in ConfusionCounts.from_dense
+    :param rows: row of every membership
+    :param values: slice value of every membership
+    :return: slice values, (G, ) row counts and ConfusionCounts with (G, L) arrays
+    """
+    labels, predictions, classes = ConfusionCounts.binarize(labels, predictions, threshold)
+    codes, uniques = pd.factorize(pd.Series(values), sort=True)
+    order = np.argsort(codes, kind='stable')
+    rows = np.asarray(rows)[order]
+    starts = np.searchsorted(codes[order], np.arange(len(uniques)))
+    labels = labels[rows]
+    predictions = predictions[rows]
+
+    def count(mask):
+        return np.add.reduceat(mask.astype(np.int64), starts, axis=0)
+
+    counts = ConfusionCounts(count(labels & predictions), count(~labels & predictions),
+                             count(labels & ~predictions), classes)
+    return np.asarray(uniques, dtype=object), np.diff(np.append(starts, len(rows))), counts
+
+
+def slice_table(labels, predictions, slices, average='weighted', threshold=0.5):
+    """
+    Score every value of every slice into a single table
+    :param slices: dict from slice name to (rows, values), see card_slices
+    :param average: 'micro', 'macro' or 'weighted' average over the labels of a slice
+    :return: DataFrame with slice, value, cards, support, precision, recall and f1 columns
+    """
+    tables = []
+    for name, (rows, values) in slices.items():
+        if len(rows) == 0:
+            continue
+        uniques, cards, counts = slice_counts(labels, predictions, rows, values, threshold)
+        scores = [ConfusionCounts(tp, fp, fn).score(average) for tp, fp, fn in zip(counts.tp, counts.fp, counts.fn)]
+        precision, recall, f1 = np.array(scores).T
+        tables.append(pd.DataFrame({'slice': name, 'value': uniques, 'cards': cards,
+                                    'support': counts.support.sum(axis=1),
+                                    'precision': precision, 'recall': recall, 'f1': f1}))
+    if len(tables) == 0:
+        return pd.DataFrame(columns=['slice', 'value', 'cards', 'support', 'precision', 'recall', 'f1'])
+    return pd.concat(tables, ignore_index=True)
+
+
+def prediction_slices(loader, folder, average='weighted', threshold=0.5):
+    """
+    Slice table of the predictions stored by a model run, see Engine.predict and BaseLoader.prob
+    The stored rows are matched to the cards of the loader through the ids of the run's manifest.
+    :param folder: prediction folder of the run, e.g. runtime/<run>/prob, or the path of its manifest
+    :return: DataFrame of slice_table
+    """
+    if os.path.isfile(folder):
+        folder = os.path.dirname(folder)
+    logits, labels = loader.load_prob(folder)
+    manifest = read_manifest(folder, loader.manifest_filename)
+    ids = np.load(os.path.join(folder, manifest['ids']))
+    cards = pd.Series(np.arange(len(loader.all_data)), index=loader.all_data['id'].to_numpy())
+    rows = cards[~cards.index.duplicated()].reindex(ids)
+    if rows.isna().any():
+        raise ValueError(f"{folder} holds {rows.isna().sum()} cards missing from the loaded dataset")
+    rows = rows.to_numpy(dtype=np.int64)
+    logits = np.asarray(logits, dtype=np.float64)
+    labels = np.asarray(labels)
+    # Multi-label logits are scored as probabilities, class logits on their arg max
+    predictions = logits.argmax(axis=1) if labels.ndim == 1 else 1 / (1 + np.exp(-logits))
+    slices = card_slices(loader.all_data.iloc[rows].reset_index(drop=True), loader.label_matrix[rows])
+    return slice_table(labels, predictions, slices, average, threshold)
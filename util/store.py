@@ -0,0 +1,161 @@
+import os
+import time
+import queue
+import atexit
+import sqlite3
+import logging
+import threading
+import pandas as pd
+
+columns = ['run', 'model', 'checkpoint', 'epoch', 'step', 'slice', 'value', 'metric', 'score', 'created']
+schema = """
+CREATE TABLE IF NOT EXISTS metrics (
+    run TEXT, model TEXT, checkpoint TEXT, epoch INTEGER, step INTEGER,
+    slice TEXT, value TEXT, metric TEXT, score REAL, created REAL
+);
+CREATE INDEX IF NOT EXISTS metrics_metric ON metrics (metric, slice, run);
+"""
+
+
+class MetricsStore:
+    """
+    Append-only SQLite table of evaluation metrics shared by every run under the runtime folder
+    Appends only enqueue rows, a background thread batches them into the database so that the training
+    loop never waits on disk. Queries read whatever has been flushed. A database that cannot be opened
+    fails the append starting the writer, a writer that dies later fails flush and close.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = None
+        self.thread = None
+        self.error = None
+        atexit.register(self.close)
+
+    def __getstate__(self):
+        # Worker processes get their own writer thread
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=60)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(schema)
+        return connection
+
+    def start(self):
+        # Open the database once here so that a bad path or schema raises in the caller
+        self.connect().close()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.write_loop, name="MetricsStore", daemon=True)
+        self.thread.start()
+
+    def write_loop(self):
+        try:
+            connection = self.connect()
+        except Exception as error:
+            self.error = error
+            logging.error(f"MetricsStore writer could not open {self.path}: {error}")
+            return
+        while True:
+            rows = [self.queue.get()]
+            while True:
+                try:
+                    rows.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [row for row in rows if row is not None]
+            try:
+                with connection:
+                    connection.executemany(f"INSERT INTO metrics VALUES ({', '.join('?' * len(columns))})", records)
+            except sqlite3.Error as error:
+                logging.error(f"Dropped {len(records)} metrics rows: {error}")
+            for _ in rows:
+                self.queue.task_done()
+            if len(records) < len(rows):
+                connection.close()
+                return
+
+    def append(self, run, metrics, model="", checkpoint="", epoch=None, step=None, slice="all", value=""):
+        """
+        Enqueue one row per metric, returns immediately
+        :param metrics: dict from metric name to score
+        """
+        if self.thread is None or not self.thread.is_alive():
+            self.start()
+        created = time.time()
+        epoch = None if epoch is None else int(epoch)
+        for metric, score in metrics.items():
+            self.queue.put((run, model, checkpoint, epoch, step, slice, str(value), metric, float(score), created))
+
+    def append_table(self, run, table, model="", checkpoint="", epoch=None, step=None, average='weighted'):
+        """
+        Enqueue a slice table as produced by util.slices.slice_table
+        :param average: average the table was scored with, used to name its metrics like ConfusionCounts.report
+        """
+        for row in table.itertuples(index=False):
+            self.append(run, {f'{average}_precision': row.precision, f'{average}_recall': row.recall,
+                              f'{average}_f1': row.f1, 'cards': row.cards, 'support': row.support},
+                        model, checkpoint, epoch, step, row.slice, row.value)
+
+    def flush(self):
+        """
+        Wait until every enqueued row is written, raises instead of waiting on a writer that died
+        """
+        if self.queue is None:
+            return
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                if not self.thread.is_alive():
+                    raise RuntimeError(f"MetricsStore writer of {self.path} stopped with "
+                                       f"{self.queue.unfinished_tasks} rows unwritten") from self.error
+                self.queue.all_tasks_done.wait(0.1)
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError(f"MetricsStore writer of {self.path} failed") from error
+
+    def query(self, **filters):
+        """
+        Read flushed rows, every keyword filters a column on one value or a list of values
+        e.g. query(metric='weighted_f1', slice='all', model=['DebertaV2XLarge', 'DebertaLarge'])
+        :return: DataFrame of the matching rows in insertion order
+        """
+        clauses = []
+        parameters = []
+        for column, accepted in filters.items():
+            if column not in columns:
+                raise ValueError(f"Unknown column {column}, expected one of {columns}")
+            accepted = accepted if isinstance(accepted, (list, tuple, set)) else [accepted]
+            clauses.append(f"{column} IN ({', '.join('?' * len(accepted))})")
+            parameters.extend(accepted)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        if not os.path.isfile(self.path):
+            return pd.DataFrame(columns=columns)
+        connection = self.connect()
+        try:
+            return pd.read_sql_query(f"SELECT * FROM metrics{where} ORDER BY rowid", connection, params=parameters)
+        finally:
+            connection.close()
+
+    def compare(self, metric='weighted_f1', slice='all', value=''):
+        """
+        Best and last score of every run on one metric
+        :return: DataFrame indexed by run with model, best, best_epoch, best_step, last and evaluations columns
+        """
+        rows = self.query(metric=metric, slice=slice, value=value)
+        if len(rows) == 0:
+            return pd.DataFrame(columns=['model', 'best', 'best_epoch', 'best_step', 'last', 'evaluations'])
+        groups = rows.groupby('run', sort=False)
+        best = rows.loc[groups.score.idxmax()].set_index('run')
+        return pd.DataFrame({'model': best.model, 'best': best.score, 'best_epoch': best.epoch,
+                             'best_step': best.step, 'last': groups.score.last(),
+                             'evaluations': groups.size()}).sort_values('best', ascending=False)